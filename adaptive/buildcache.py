@@ -0,0 +1,115 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Content-addressed cache of generated code.
+
+An entry is keyed on everything that determines the output of one
+backend: the IDL sources, the code of the compiler, the annotators and
+quark, and which side (client or server) is generated. The entry holds the
+tree of files the backend emitted.
+"""
+
+import os, shutil, hashlib, tempfile
+
+
+def module_digest(module):
+    """Digest of the source of module, so that editing a generator invalidates its entries"""
+    path = module.__file__
+    if path.endswith((".pyc", ".pyo")) and os.path.exists(path[:-1]):
+        path = path[:-1]
+    with open(path, "rb") as fd:
+        return hashlib.sha1(fd.read()).hexdigest()
+
+
+def fingerprint(side, backend, sources, modules):
+    """
+    side is "client" or "server", backend a quark backend class, sources a
+    list of (file name, contents) and modules the code generating modules.
+    """
+    digest = hashlib.sha1()
+    for part in [side, backend.__module__, backend.__name__] + [module_digest(m) for m in modules]:
+        digest.update("%s\0" % part)
+    for name, text in sources:
+        digest.update("%d:%s\0%d:" % (len(name), name, len(text)))
+        digest.update(text)
+    return digest.hexdigest()
+
+
+def files(root):
+    """Paths of all files under root, relative to root"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, filename), root)
+
+
+def sync(source, target):
+    """
+    Copy the files under source to target, leaving files whose contents
+    are already the same untouched so that their timestamps do not
+    trigger downstream rebuilds. Returns the paths that were written.
+    """
+    written = []
+    for path in files(source):
+        with open(os.path.join(source, path), "rb") as fd:
+            data = fd.read()
+        dest = os.path.join(target, path)
+        try:
+            with open(dest, "rb") as fd:
+                if fd.read() == data:
+                    continue
+        except IOError:
+            pass
+        directory = os.path.dirname(dest)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(dest, "wb") as fd:
+            fd.write(data)
+        written.append(path)
+    return written
+
+
+class BuildCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, key):
+        """Directory holding the output stored for key, or None"""
+        path = self.path(key)
+        if os.path.isdir(path):
+            return path
+        return None
+
+    def store(self, key, output):
+        """Copy the output directory into the cache under key and return its location"""
+        path = self.path(key)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        # Populate a scratch copy and rename it into place so that an
+        # interrupted build never leaves a partial entry behind.
+        scratch = tempfile.mkdtemp(dir=parent)
+        try:
+            sync(output, scratch)
+            os.rename(scratch, path)
+        except OSError:
+            shutil.rmtree(scratch, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        return path
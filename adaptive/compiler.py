@@ -16,8 +16,8 @@
 Adaptive
 
 Usage:
-  adaptive client [--java=<dir>] [--python=<dir>] <file> ...
-  adaptive server [--java=<dir>] [--python=<dir>] <file> ...
+  adaptive client [--java=<dir>] [--python=<dir>] [--cache=<dir>] [--jobs=<n>] [--async] <file> ...
+  adaptive server [--java=<dir>] [--python=<dir>] [--cache=<dir>] [--jobs=<n>] [--async] <file> ...
   adaptive -h | --help
   adaptive --version
 
@@ -26,47 +26,136 @@ Options:
   --version       Show version.
   --java=<dir>    Emit java code to specified directory.
   --python=<dir>  Emit python code to specified directory.
+  --cache=<dir>   Reuse code generated from identical inputs by earlier runs.
+  --jobs=<n>      Generate code for the backends in up to n processes [default: 1].
+  --async         Also generate client methods that return a future of
+                  the result without waiting for it.
 """
 
-import sys
+import sys, shutil, tempfile, multiprocessing
 
 from docopt import docopt
 
-import _metadata, generate
+import _metadata, generate, emit, buildcache
 from quark.compiler import Compiler, ParseError, CompileError
 from quark.backend import Java, Python
 
+ANNOTATORS = {"client": generate.service_client, "server": generate.service_server}
+
+def generate_code(side, sources, emitters, asynchronous=False):
+    """
+    Compile sources, a list of (file name, contents), with one quark
+    emitter per (backend, directory) pair. Returns the diagnostic on
+    failure and None on success.
+    """
+    compiler = Compiler()
+    service = ANNOTATORS[side]
+    compiler.annotator("value", generate.value)
+    supported = set()  # packages whose support types were emitted
+    compiler.annotator("service", lambda node: service(node, asynchronous, supported))
+    for backend, directory in emitters:
+        compiler.emitter(backend, directory)
+    try:
+        for name, text in sources:
+            compiler.parse(name, text)
+        compiler.compile()
+    except ParseError, e:
+        return e
+    except CompileError, e:
+        return e
+
+def code_modules():
+    """
+    The modules whose code determines the generated code: this one, the
+    annotators, and all of quark that is loaded, backends included.
+    """
+    quark = [module for name, module in sorted(sys.modules.items())
+             if name.split(".")[0] == "quark" and getattr(module, "__file__", None)]
+    return [sys.modules[__name__], generate, emit] + quark
+
+def generate_job(job):
+    # Runs in a pool worker. Diagnostics are returned as text since quark's
+    # exceptions are not guaranteed to pickle.
+    error = generate_code(*job)
+    if error is not None:
+        return str(error)
+
 def main(args):
     if args["--version"]:
         sys.stderr.write("Adaptive %s\n" % _metadata.__version__)
         return
 
-    compiler = Compiler()
-    compiler.annotator("value", generate.value)
-
     if args["client"]:
-        compiler.annotator("service", generate.service_client)
+        side = "client"
     elif args["server"]:
-        compiler.annotator("service", generate.service_server)
+        side = "server"
     else:
         assert False
 
     java = args["--java"]
     python = args["--python"]
-    if java: compiler.emitter(Java, java)
-    if python: compiler.emitter(Python, python)
+    asynchronous = args["--async"]
+    flags = "+async" if asynchronous else ""
+    cache = buildcache.BuildCache(args["--cache"]) if args["--cache"] else None
+    try:
+        jobs = int(args["--jobs"] or 1)
+    except ValueError:
+        return "--jobs must be a number"
 
     try:
+        sources = []
         for name in args["<file>"]:
             with open(name, "rb") as fd:
-                compiler.parse(name, fd.read())
-        compiler.compile()
+                sources.append((name, fd.read()))
     except IOError, e:
         return e
-    except ParseError, e:
-        return e
-    except CompileError, e:
-        return e
+
+    # Each backend emits into a scratch directory that is then synced to
+    # its target, so that files whose contents did not change are not
+    # rewritten. With a cache, a backend whose inputs are unchanged is
+    # not run at all.
+    outputs = []  # (target, scratch or cached output)
+    scratch = []  # (backend, scratch, cache key)
+    try:
+        for backend, target in ((Java, java), (Python, python)):
+            if not target:
+                continue
+            key = buildcache.fingerprint(side + flags, backend, sources, code_modules())
+            cached = cache.lookup(key) if cache else None
+            if cached is None:
+                output = tempfile.mkdtemp()
+                scratch.append((backend, output, key))
+                outputs.append((target, output))
+            else:
+                outputs.append((target, cached))
+
+        emitters = [(backend, output) for backend, output, key in scratch]
+        if jobs > 1 and len(emitters) > 1:
+            # Quark resolves names across all the files of a compilation, so
+            # the unit of work is a whole compilation for one backend. The
+            # results come back in backend order, so the first diagnostic
+            # reported is the one a serial run would report.
+            pool = multiprocessing.Pool(min(jobs, len(emitters)))
+            try:
+                errors = pool.map(generate_job, [(side, sources, [emitter], asynchronous) for emitter in emitters])
+            finally:
+                pool.terminate()
+            for error in errors:
+                if error is not None:
+                    return error
+        elif emitters or not outputs:
+            error = generate_code(side, sources, emitters, asynchronous)
+            if error is not None:
+                return error
+
+        if cache:
+            stored = dict((output, cache.store(key, output)) for backend, output, key in scratch)
+            outputs = [(target, stored.get(output, output)) for target, output in outputs]
+        for target, output in outputs:
+            buildcache.sync(output, target)
+    finally:
+        for backend, output, key in scratch:
+            shutil.rmtree(output, ignore_errors=True)
 
     if not java and not python:
         return "no output languages specified"
@@ -20,20 +20,36 @@ def value(node):
     with out.block('package %s' % code(node.package.name)):
         node.traverse(EncodeGenerator(out))
         node.traverse(DecodeGenerator(out))
+        node.traverse(RepositoryGenerator(out))
     return out.dumps()
 
-def service_client(node):
+# The support types a client or server needs are the same for every
+# service of a package, so they are emitted with the first one only. Pass
+# the same supported set for all services of one compilation.
+
+def service_client(node, asynchronous=False, supported=None):
     out = Emitter()
-    with out.block('package %s' % code(node.package.name)):
-        node.traverse(ClientGenerator(out))
+    package = code(node.package.name)
+    with out.block('package %s' % package):
+        node.traverse(ClientGenerator(out, asynchronous, first(supported, package)))
     return out.dumps()
 
-def service_server(node):
+def service_server(node, asynchronous=False, supported=None):  # asynchronous is for clients only
     out = Emitter()
-    with out.block('package %s' % code(node.package.name)):
-        node.traverse(ServerGenerator(out))
+    package = code(node.package.name)
+    with out.block('package %s' % package):
+        node.traverse(ServerGenerator(out, first(supported, package)))
     return out.dumps()
 
+def first(supported, package):
+    """True unless package is in supported; adds it"""
+    if supported is None:
+        return True
+    if package in supported:
+        return False
+    supported.add(package)
+    return True
+
 class Generator(object):
 
     def __init__(self, emitter):
@@ -76,53 +92,809 @@ class DecodeGenerator(Generator):
         self.out.dedent()
         self.out('}')
 
+class RepositoryGenerator(Generator):
+
+    """
+    For a class annotated @store("key", "field", ...), emit <Class>Repository:
+    an in-memory store with a hash index on the primary key and one on each
+    of the other fields named. The indexes hold the field values as of the
+    last put, so put a value again after changing its indexed fields.
+    """
+
+    def visit_Class(self, cls):
+        ann = self.get_annotation(cls, "store")
+        if ann is None:
+            return
+        fields = [code(arg).strip('"') for arg in ann.arguments]
+        key, indexes = fields[0], fields[1:]
+        name = code(cls.name)
+        bucket = "Map<Object,%s>" % name
+        index = "Map<Object,%s>" % bucket
+        with self.out.block("class %sRepository" % name):
+            self.out("%s items = new %s();" % (bucket, bucket))
+            for field in indexes:
+                self.out("%s by_%s = new %s();" % (index, field, index))
+                self.out("Map<Object,Object> %s_of = new Map<Object,Object>();" % field)
+
+            with self.out.block("int size()"):
+                self.out("return items.keys().size();")
+
+            with self.out.block("%s get(Object %s)" % (name, key)):
+                with self.out.block("if (items.contains(%s))" % key):
+                    self.out("return items[%s];" % key)
+                self.out("return null;")
+
+            with self.out.block("List<%s> all()" % name):
+                self.out("return self.values(items);")
+
+            with self.out.block("void put(%s value)" % name):
+                self.out("self.remove(value.%s);" % key)
+                self.out("items[value.%s] = value;" % key)
+                for field in indexes:
+                    self.out("%s_of[value.%s] = value.%s;" % (field, key, field))
+                    self.out("%s %s_bucket = self.bucket(by_%s, value.%s);" % (bucket, field, field, field))
+                    self.out("%s_bucket[value.%s] = value;" % (field, key))
+
+            with self.out.block("%s remove(Object %s)" % (name, key)):
+                with self.out.block("if (items.contains(%s) == false)" % key):
+                    self.out("return null;")
+                self.out("%s value = items[%s];" % (name, key))
+                self.out("items.remove(%s);" % key)
+                for field in indexes:
+                    self.out("self.unindex(by_%s, %s_of[%s], %s);" % (field, field, key, key))
+                    self.out("%s_of.remove(%s);" % (field, key))
+                self.out("return value;")
+
+            for field in indexes:
+                with self.out.block("List<%s> find_by_%s(Object %s)" % (name, field, field)):
+                    with self.out.block("if (by_%s.contains(%s))" % (field, field)):
+                        self.out("return self.values(by_%s[%s]);" % (field, field))
+                    self.out("return new List<%s>();" % name)
+
+            with self.out.block("List<%s> values(%s map)" % (name, bucket)):
+                self.out("List<%s> result = new List<%s>();" % (name, name))
+                self.out("List<Object> keys = map.keys();")
+                self.out("int idx = 0;")
+                with self.out.block("while (idx < keys.size())"):
+                    self.out("result.add(map[keys[idx]]);")
+                    self.out("idx = idx + 1;")
+                self.out("return result;")
+
+            if indexes:
+                with self.out.block("%s bucket(%s index, Object value)" % (bucket, index)):
+                    with self.out.block("if (index.contains(value) == false)"):
+                        self.out("index[value] = new %s();" % bucket)
+                    self.out("return index[value];")
+
+                with self.out.block("void unindex(%s index, Object value, Object %s)" % (index, key)):
+                    self.out("%s bucket = index[value];" % bucket)
+                    self.out("bucket.remove(%s);" % key)
+                    with self.out.block("if (bucket.keys().size() == 0)"):
+                        self.out("index.remove(value);")
+
+CACHE_SUPPORT = """
+interface CacheSizer {
+    // Estimate the size in bytes of a cached result.
+    long size(Map<String,Object> result);
+}
+
+class CacheEntry {
+    Object key;
+    Map<String,Object> result;
+    long timestamp = 0;
+    long size = 0;
+    CacheEntry prev;
+    CacheEntry next;
+
+    // Background refresh state, written by RPCClient.prefetch.
+    bool refreshing = false;
+    Map<String,Object> pending;
+    long fetched = 0;
+
+    void refreshed(Map<String,Object> result) {
+        fetched = now();
+        pending = result;
+        refreshing = false;
+    }
+
+    void refresh_failed() {
+        refreshing = false;
+    }
+}
+
+// Not thread-safe: the client holds RPCClient's lock around every use.
+class Cache {
+    long ttl = 0;
+    long stale_ttl = 0;    // how long past ttl a stale result may be served
+    long max_entries = 0;  // 0 means no limit
+    long max_bytes = 0;    // 0 means no limit; needs a sizer to take effect
+    CacheSizer sizer;
+
+    Map<Object,CacheEntry> entries = new Map<Object,CacheEntry>();
+    CacheEntry head;  // most recently used
+    CacheEntry tail;  // least recently used
+    long count = 0;
+    long bytes = 0;
+
+    long hits = 0;
+    long misses = 0;
+    long evictions = 0;
+    long expirations = 0;
+    long stale = 0;
+
+    bool expired(CacheEntry entry) {
+        return (now() - entry.timestamp) > ttl;
+    }
+
+    // The unexpired entry for key, or null, without counting a lookup.
+    CacheEntry peek(Object key) {
+        if (entries.contains(key)) {
+            CacheEntry entry = entries[key];
+            if (self.expired(entry) == false) {
+                return entry;
+            }
+        }
+        return null;
+    }
+
+    bool reclaimable(CacheEntry entry) {
+        return (now() - entry.timestamp) > ttl + stale_ttl;
+    }
+
+    void unlink(CacheEntry entry) {
+        if (entry.prev != null) {
+            entry.prev.next = entry.next;
+        } else {
+            head = entry.next;
+        }
+        if (entry.next != null) {
+            entry.next.prev = entry.prev;
+        } else {
+            tail = entry.prev;
+        }
+        entry.prev = null;
+        entry.next = null;
+    }
+
+    void push(CacheEntry entry) {
+        entry.next = head;
+        if (head != null) {
+            head.prev = entry;
+        }
+        head = entry;
+        if (tail == null) {
+            tail = entry;
+        }
+    }
+
+    void drop(CacheEntry entry) {
+        self.unlink(entry);
+        entries.remove(entry.key);
+        count = count - 1;
+        bytes = bytes - entry.size;
+    }
+
+    // Install a result delivered by a background refresh.
+    void settle(CacheEntry entry) {
+        if (entry.pending != null) {
+            entry.result = entry.pending;
+            entry.timestamp = entry.fetched;
+            entry.pending = null;
+            if (sizer != null) {
+                bytes = bytes - entry.size;
+                entry.size = sizer.size(entry.result);
+                bytes = bytes + entry.size;
+            }
+        }
+    }
+
+    CacheEntry lookup(Object key) {
+        if (entries.contains(key)) {
+            CacheEntry entry = entries[key];
+            self.settle(entry);
+            if (self.reclaimable(entry)) {
+                self.drop(entry);
+                expirations = expirations + 1;
+            } else {
+                self.unlink(entry);
+                self.push(entry);
+                if (self.expired(entry)) {
+                    stale = stale + 1;
+                } else {
+                    hits = hits + 1;
+                }
+                return entry;
+            }
+        }
+        misses = misses + 1;
+        return null;
+    }
+
+    CacheEntry store(Object key, Map<String,Object> result) {
+        if (entries.contains(key)) {
+            self.drop(entries[key]);
+        }
+        CacheEntry entry = new CacheEntry();
+        entry.key = key;
+        entry.result = result;
+        entry.timestamp = now();
+        if (sizer != null) {
+            entry.size = sizer.size(result);
+        }
+        entries[key] = entry;
+        self.push(entry);
+        count = count + 1;
+        bytes = bytes + entry.size;
+        self.evict();
+        return entry;
+    }
+
+    bool full() {
+        if (max_entries > 0) {
+            if (count > max_entries) {
+                return true;
+            }
+        }
+        if (max_bytes > 0) {
+            if (bytes > max_bytes) {
+                return true;
+            }
+        }
+        return false;
+    }
+
+    void evict() {
+        while (tail != null) {
+            if (self.reclaimable(tail)) {
+                self.drop(tail);
+                expirations = expirations + 1;
+            } else {
+                if (self.full()) {
+                    // Never evict the entry that was just stored.
+                    if (tail == head) {
+                        return;
+                    }
+                    self.drop(tail);
+                    evictions = evictions + 1;
+                } else {
+                    return;
+                }
+            }
+        }
+    }
+
+    void purge() {
+        CacheEntry entry = tail;
+        while (entry != null) {
+            CacheEntry prev = entry.prev;
+            if (self.reclaimable(entry)) {
+                self.drop(entry);
+                expirations = expirations + 1;
+            }
+            entry = prev;
+        }
+    }
+}
+"""
+
+INDEX_SUPPORT = """
+class IndexUpdate {
+    long version = 0;
+    String name;
+    Map<String,Object> args;
+    Map<String,Object> result;  // null when the entry was retracted
+
+    Map<String,Object> toMap() {
+        Map<String,Object> map = new Map<String,Object>();
+        map["name"] = name;
+        map["args"] = args;
+        map["result"] = result;
+        return map;
+    }
+}
+
+interface HostLock {
+    // Supplied by threaded hosts, since Quark has no locks of its own.
+    void lock();
+    void unlock();
+}
+
+class IndexLog {
+    long version = 0;
+    int max_updates = 1024;
+    HostLock guard = null;  // held around record, snapshot and updates when set
+    // The latest result of each indexed call, kept until it is retracted.
+    // There is one per distinct call served or published, so it grows with
+    // the data the service holds rather than with traffic; only the log is
+    // bounded, by max_updates.
+    Map<String,Map<Object,IndexUpdate>> entries = new Map<String,Map<Object,IndexUpdate>>();
+    List<IndexUpdate> log = new List<IndexUpdate>();
+
+    Map<Object,IndexUpdate> table(String name) {
+        if (entries.contains(name)) {
+            return entries[name];
+        }
+        Map<Object,IndexUpdate> t = new Map<Object,IndexUpdate>();
+        entries[name] = t;
+        return t;
+    }
+
+    void acquire() {
+        if (guard != null) {
+            guard.lock();
+        }
+    }
+
+    void release() {
+        if (guard != null) {
+            guard.unlock();
+        }
+    }
+
+    void record(String name, Map<String,Object> args, Map<String,Object> result) {
+        self.acquire();
+        self.append(name, args, result);
+        self.release();
+    }
+
+    Map<String,Object> snapshot() {
+        self.acquire();
+        Map<String,Object> map = self.read_snapshot();
+        self.release();
+        return map;
+    }
+
+    Map<String,Object> updates(long since) {
+        self.acquire();
+        Map<String,Object> map = self.read_updates(since);
+        self.release();
+        return map;
+    }
+
+    void append(String name, Map<String,Object> args, Map<String,Object> result) {
+        version = version + 1;
+        IndexUpdate update = new IndexUpdate();
+        update.version = version;
+        update.name = name;
+        update.args = args;
+        update.result = result;
+        Map<Object,IndexUpdate> t = self.table(name);
+        if (result == null) {
+            t.remove(args);
+        } else {
+            t[args] = update;
+        }
+        log.add(update);
+        if (log.size() > 2*max_updates) {
+            self.compact();
+        }
+    }
+
+    void compact() {
+        List<IndexUpdate> kept = new List<IndexUpdate>();
+        int idx = log.size() - max_updates;
+        while (idx < log.size()) {
+            kept.add(log[idx]);
+            idx = idx + 1;
+        }
+        log = kept;
+    }
+
+    Map<String,Object> read_snapshot() {
+        List<Map<String,Object>> list = new List<Map<String,Object>>();
+        List<String> names = entries.keys();
+        int i = 0;
+        while (i < names.size()) {
+            Map<Object,IndexUpdate> t = entries[names[i]];
+            List<Object> keys = t.keys();
+            int j = 0;
+            while (j < keys.size()) {
+                list.add(t[keys[j]].toMap());
+                j = j + 1;
+            }
+            i = i + 1;
+        }
+        Map<String,Object> map = new Map<String,Object>();
+        map["$version"] = version;
+        map["$entries"] = list;
+        map["$status"] = 200;
+        return map;
+    }
+
+    bool covers(long since) {
+        if (since > version) {
+            return false;
+        }
+        if (log.size() > 0) {
+            if (log[0].version > since + 1) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    Map<String,Object> read_updates(long since) {
+        Map<String,Object> map = new Map<String,Object>();
+        map["$version"] = version;
+        map["$status"] = 200;
+        // A client that has fallen behind the log has to reload the snapshot.
+        if (self.covers(since)) {
+            List<Map<String,Object>> list = new List<Map<String,Object>>();
+            int idx = 0;
+            while (idx < log.size()) {
+                if (log[idx].version > since) {
+                    list.add(log[idx].toMap());
+                }
+                idx = idx + 1;
+            }
+            map["$reset"] = false;
+            map["$entries"] = list;
+        } else {
+            map["$reset"] = true;
+        }
+        return map;
+    }
+}
+"""
+
+STREAM_SUPPORT = """
+interface RPCStream {
+    // The next element of a streamed List result, or null at the end.
+    Map<String,Object> read();
+}
+"""
+
+TRACER_SUPPORT = """
+interface ClientTracer {
+    // Called on the calling thread as each method of the client moves
+    // through its phases: "marshal" building args, "call" in the
+    // RPCClient, and "unmarshal" building the result.
+    void begin(String method, String phase);
+    void end(String method, String phase);
+}
+"""
+
+ASYNC_SUPPORT = """
+interface RPCFuture {
+    // Waits for the call to complete, and returns what call() would have.
+    Map<String,Object> result();
+}
+"""
+
 class ClientGenerator(Generator):
 
-    def visit_Interface(self, i):
-        with self.out.block("interface RPCClient"):
-            self.out("Map<String,Object> call(String name, Map<String,Object> args);")
+    """
+    With asynchronous set, methods that go to the server also get an
+    X_async variant that returns a future of the result at once. Quark
+    classes cannot nest, so the future classes are collected in a
+    separate emitter and written out after the client class.
+    """
 
-        with self.out.block("class CacheEntry"):
-            self.out("Map<String,Object> result;")
-            self.out("long timestamp = 0;")
+    def __init__(self, emitter, asynchronous=False, support=True):
+        Generator.__init__(self, emitter)
+        self.asynchronous = asynchronous
+        self.support = support
+        self.streamed = []
+        self.futures = Emitter()
 
-        self.out("class %sClient {" % i.name.text)
+    def visit_Interface(self, i):
+        if self.support:
+            with self.out.block("interface RPCClient"):
+                self.out("Map<String,Object> call(String name, Map<String,Object> args);")
+                self.out("// Idempotent call: concurrent identical fetches may share one request.")
+                self.out("Map<String,Object> fetch(String name, Map<String,Object> args);")
+                self.out("// Fetch in the background and report to entry.refreshed/refresh_failed.")
+                self.out("void prefetch(String name, Map<String,Object> args, CacheEntry entry);")
+                self.out("// Call a List-returning method and read the elements as they arrive.")
+                self.out("RPCStream stream(String name, Map<String,Object> args);")
+                self.out("// Guard the client's shared state; calls may come from many threads.")
+                self.out("void lock();")
+                self.out("void unlock();")
+                if self.asynchronous:
+                    self.out("// Call or fetch without waiting for the result.")
+                    self.out("RPCFuture call_async(String name, Map<String,Object> args, bool idempotent);")
+            self.out(STREAM_SUPPORT)
+            self.out(TRACER_SUPPORT)
+            if self.asynchronous:
+                self.out(ASYNC_SUPPORT)
+            self.out(CACHE_SUPPORT)
+            self.out(INDEX_SUPPORT)
+
+        self.name = i.name.text
+        self.out("class %sClient {" % self.name)
         self.out.indent()
         self.out("RPCClient rpc;")
         self.out("""
+        ClientTracer tracer = null;
+
+        void trace_begin(String method, String phase) {
+            if (tracer != null) {
+                tracer.begin(method, phase);
+            }
+        }
+
+        void trace_end(String method, String phase) {
+            if (tracer != null) {
+                tracer.end(method, phase);
+            }
+        }
+
+        long index_version = -1;
+        long index_synced = 0;
+        // ms between syncs made by index(), which also loads the index on
+        // first use; 0 to leave loading and syncing to the host.
+        long index_interval = 1000;
+        Map<String,Map<Object,Map<String,Object>>> index_entries = new Map<String,Map<Object,Map<String,Object>>>();
+
+        Map<Object,Map<String,Object>> index_table(String name) {
+            if (index_entries.contains(name)) {
+                return index_entries[name];
+            }
+            Map<Object,Map<String,Object>> table = new Map<Object,Map<String,Object>>();
+            index_entries[name] = table;
+            return table;
+        }
+
+        void index_apply(List<Map<String,Object>> updates) {
+            int idx = 0;
+            while (idx < updates.size()) {
+                Map<String,Object> update = updates[idx];
+                String name = update["name"];
+                Map<String,Object> args = update["args"];
+                Map<String,Object> result = update["result"];
+                Map<Object,Map<String,Object>> table = self.index_table(name);
+                if (result == null) {
+                    table.remove(args);
+                } else {
+                    table[args] = result;
+                }
+                idx = idx + 1;
+            }
+        }
 
-        Map<Object,Map<String,Object>> index_entries = new Map<Object,Map<String,Object>>();
+        // Replace the local index with a snapshot of the server's index.
+        void index_load() {
+            Map<String,Object> map = self.rpc.call("$index_snapshot", new Map<String,Object>());
+            long version = map["$version"];
+            self.rpc.lock();
+            // Unless a sync that finished first got further.
+            if (version >= index_version) {
+                index_entries = new Map<String,Map<Object,Map<String,Object>>>();
+                self.index_apply(map["$entries"]);
+                index_version = version;
+            }
+            index_synced = now();
+            self.rpc.unlock();
+        }
+
+        // Apply the updates published since the last load or sync.
+        void index_sync() {
+            self.rpc.lock();
+            long since = index_version;
+            self.rpc.unlock();
+            if (since < 0) {
+                self.index_load();
+                return;
+            }
+            Map<String,Object> args = new Map<String,Object>();
+            args["since"] = since;
+            Map<String,Object> map = self.rpc.call("$index_updates", args);
+            bool reset = map["$reset"];
+            if (reset) {
+                self.index_load();
+                return;
+            }
+            self.rpc.lock();
+            if (index_version == since) {
+                self.index_apply(map["$entries"]);
+                index_version = map["$version"];
+            }
+            index_synced = now();
+            self.rpc.unlock();
+        }
 
         Map<String,Object> index(String name, Map<String,Object> args) {
-            // XXX: nothing updates the index right now!!!
-            return index_entries[args];
+            // One caller at a time loads or syncs the index, taking its turn
+            // by moving index_synced on; the others read the index as it is.
+            // A load or sync that fails is tried again after index_interval.
+            bool due = false;
+            self.rpc.lock();
+            if (index_interval > 0) {
+                long at = now();
+                if (at - index_synced > index_interval) {
+                    index_synced = at;
+                    due = true;
+                }
+            }
+            self.rpc.unlock();
+            if (due) {
+                self.index_sync();
+            }
+            self.rpc.lock();
+            // Until the index has been loaded, go to the server.
+            if (index_version < 0) {
+                self.rpc.unlock();
+                return self.rpc.call(name, args);
+            }
+            Map<Object,Map<String,Object>> table = self.index_table(name);
+            if (table.contains(args)) {
+                Map<String,Object> found = table[args];
+                self.rpc.unlock();
+                return found;
+            }
+            self.rpc.unlock();
+            // The server only indexes results it has served or published,
+            // so ask it, and keep the answer until an update replaces it.
+            Map<String,Object> result = self.rpc.call(name, args);
+            if (result != null) {
+                self.rpc.lock();
+                Map<Object,Map<String,Object>> kept = self.index_table(name);
+                kept[args] = result;
+                self.rpc.unlock();
+            }
+            return result;
+        }
+
+        long cache_max_entries = 0;
+        long cache_max_bytes = 0;
+        long cache_stale_ttl = 0;
+        CacheSizer cache_sizer;
+        Map<String,Cache> caches = new Map<String,Cache>();
+
+        void configure(Cache c) {
+            c.max_entries = cache_max_entries;
+            c.max_bytes = cache_max_bytes;
+            c.stale_ttl = cache_stale_ttl;
+            c.sizer = cache_sizer;
+            c.evict();
         }
 
-        Map<Object,CacheEntry> cache_entries = new Map<Object,CacheEntry>();
+        void reconfigure() {
+            List<String> names = caches.keys();
+            int idx = 0;
+            while (idx < names.size()) {
+                self.configure(caches[names[idx]]);
+                idx = idx + 1;
+            }
+        }
+
+        void configure_cache(long max_entries, long max_bytes, CacheSizer sizer) {
+            self.rpc.lock();
+            cache_max_entries = max_entries;
+            cache_max_bytes = max_bytes;
+            cache_sizer = sizer;
+            self.reconfigure();
+            self.rpc.unlock();
+        }
 
+        // Serve expired results for up to window ms while one background
+        // refresh runs. A window of 0 turns stale-while-revalidate off.
+        void serve_stale(long window) {
+            self.rpc.lock();
+            cache_stale_ttl = window;
+            self.reconfigure();
+            self.rpc.unlock();
+        }
+
+        Cache cache_for(String name, long threshold) {
+            if (caches.contains(name)) {
+                return caches[name];
+            }
+            Cache c = new Cache();
+            c.ttl = threshold;
+            self.configure(c);
+            caches[name] = c;
+            return c;
+        }
+
+        // The lock is held around each use of the cache, but not while
+        // waiting for the server.
         Map<String,Object> cache(String name, Map<String,Object> args, long threshold) {
-            CacheEntry entry;
-            if (cache_entries.contains(args)) {
-                entry = cache_entries[args];
-            } else {
-                entry = new CacheEntry();
-                cache_entries[args] = entry;
+            self.rpc.lock();
+            Cache c = self.cache_for(name, threshold);
+            CacheEntry entry = c.lookup(args);
+            if (entry != null) {
+                Map<String,Object> result = entry.result;
+                bool refresh = false;
+                if (c.expired(entry)) {
+                    if (entry.refreshing == false) {
+                        entry.refreshing = true;
+                        refresh = true;
+                    }
+                }
+                self.rpc.unlock();
+                if (refresh) {
+                    self.rpc.prefetch(name, args, entry);
+                }
+                return result;
             }
-            if ((now() - entry.timestamp) > threshold) {
-                entry.result = self.rpc.call(name, args);
-                entry.timestamp = now();
+            self.rpc.unlock();
+            Map<String,Object> fetched = self.rpc.fetch(name, args);
+            self.rpc.lock();
+            // Every thread that shared the fetch gets here; the first stores it.
+            entry = c.peek(args);
+            if (entry == null) {
+                c.store(args, fetched);
+            } else {
+                fetched = entry.result;
             }
-            return entry.result;
+            self.rpc.unlock();
+            return fetched;
         }
         """)
 
     def leave_Interface(self, i):
         self.out.dedent()
         self.out("}")
+        for elem in self.streamed:
+            self.stream_class(elem)
+        for line in self.futures.destination.lines:
+            self.out(line)
+        self.futures = Emitter()
+
+    def stream_class(self, elem):
+        with self.out.block("class %sStream" % elem):
+            self.out("RPCStream stream;")
+            with self.out.block("%sStream(RPCStream stream)" % elem):
+                self.out("self.stream = stream;")
+            with self.out.block("%s next()" % elem):
+                self.out("Map<String,Object> map = stream.read();")
+                with self.out.block("if (map == null)"):
+                    self.out("return null;")
+                self.out("return %s_fromMap(map);" % elem)
+
+    def stream_method(self, m):
+        elem = code(m.type.parameters[0])
+        if elem not in self.streamed:
+            self.streamed.append(elem)
+        with self.out.block("%sStream %s_stream(%s)" % (elem, code(m.name), code(m.params))):
+            self.out("Map<String,Object> args = new Map<String,Object>();")
+            for p in m.params:
+                self.visit_Param(p)
+            self.out('return new %sStream(self.rpc.stream("%s", args));' % (elem, code(m.name)))
+
+    def trace(self, m, event, phase):
+        self.out('self.trace_%s("%s", "%s");' % (event, code(m.name), phase))
+
+    def async_method(self, m, idempotent):
+        future = "%sClient_%sFuture" % (self.name, code(m.name))
+        with self.out.block("%s %s_async(%s)" % (future, code(m.name), code(m.params))):
+            self.out("Map<String,Object> args = new Map<String,Object>();")
+            for p in m.params:
+                self.visit_Param(p)
+            self.out('return new %s(self.rpc.call_async("%s", args, %s));' % (
+                future, code(m.name), "true" if idempotent else "false"))
+
+        out = self.futures
+        with out.block("class %s" % future):
+            out("RPCFuture future;")
+            with out.block("%s(RPCFuture future)" % future):
+                out("self.future = future;")
+            with out.block("%s get()" % code(m.type)):
+                if code(m.type.path[0]) == "void":
+                    out("future.result();")
+                else:
+                    out("Map<String,Object> map = future.result();")
+                    self.from_map(out, m)
+                    out("return result;")
+
+    def from_map(self, out, m):
+        # Declares result, decoded from map
+        if code(m.type.path[0]) == "List":
+            out('%s result = new %s();' % (code(m.type), code(m.type)))
+            out('List<Map<String,Object>> list = map["$result"];')
+            with out.block('if (list != null)'):
+                out('int idx = 0;')
+                with out.block('while (idx < list.size())'):
+                    out('result.add(%s_fromMap(list[idx]));' % code(m.type.parameters[0]))
+                    out('idx = idx + 1;')
+        else:
+            out('%s result = %s_fromMap(map);' % (code(m.type), code(m.type)))
 
     def visit_Method(self, m):
         self.out("%s %s(%s) {" % (m.type.code(), m.name.code(), code(m.params)))
         self.out.indent()
+        self.trace(m, "begin", "marshal")
         self.out("Map<String,Object> args = new Map<String,Object>();")
 
     def visit_Param(self, p):
@@ -136,79 +908,203 @@ class ClientGenerator(Generator):
             ann = self.get_annotation(m, "cache")
             meth = "cache"
             extra = ", %s" % code(ann.arguments, ", ")
+        elif self.get_annotation(m, "query"):
+            meth = "rpc.fetch"
+            extra = ""
         else:
             meth = "rpc.call"
             extra = ""
 
-        self.out('Map<String,Object> map = self.%s("%s", args%s);' % (meth, code(m.name), extra))
         tname = code(m.type.path[0])
+        self.trace(m, "end", "marshal")
+        self.trace(m, "begin", "call")
+        self.out('Map<String,Object> map = self.%s("%s", args%s);' % (meth, code(m.name), extra))
+        self.trace(m, "end", "call")
         if tname != "void":
-            if tname == "List":
-                self.out('%s result = new %s();' % (code(m.type), code(m.type)))
-                self.out('List<Map<String,Object>> list = map["$result"];')
-                with self.out.block('if (list != null)'):
-                    self.out('int idx = 0;')
-                    with self.out.block('while (idx < list.size())'):
-                        self.out('result.add(%s_fromMap(list[idx]));' % code(m.type.parameters[0]))
-                        self.out('idx = idx + 1;')
-            else:
-                self.out('%s result = %s_fromMap(map);' % (code(m.type), code(m.type)))
+            if meth == "index":
+                with self.out.block('if (map == null)'):
+                    self.out('return null;')
+            self.trace(m, "begin", "unmarshal")
+            self.from_map(self.out, m)
+            self.trace(m, "end", "unmarshal")
             self.out('return result;')
         self.out.dedent()
         self.out('}')
+        self.variants(m, meth)
+
+    def variants(self, m, meth):
+        if self.asynchronous and meth in ("rpc.call", "rpc.fetch"):
+            self.async_method(m, meth == "rpc.fetch")
+        if code(m.type.path[0]) == "List":
+            self.stream_method(m)
+
+DISPATCH_SUPPORT = """
+interface MethodHandler {
+    Map<String,Object> handle(Map<String,Object> args);
+}
+"""
+
+OBSERVER_SUPPORT = """
+interface CallObserver {
+    // Called around each call the server dispatches, so that the host
+    // can time the implementation. result is what call() returns.
+    void begin(String name);
+    void end(String name, Map<String,Object> result);
+}
+"""
 
 class ServerGenerator(Generator):
 
+    """
+    The server dispatches through a table from method name to a handler
+    object, built once in the constructor. Quark classes cannot nest, so
+    the handler classes are collected in a separate emitter and written
+    out after the server class.
+
+    The constructor also lists the @query methods in queries, and for each
+    method annotated @invalidates("query", ...) the queries named, for
+    caches of query results; see python/resultcache.py.
+    """
+
+    def __init__(self, emitter, support=True):
+        Generator.__init__(self, emitter)
+        self.support = support
+        self.indexed = []
+        self.methods = []
+        self.handlers = Emitter()
+
+    def handler_name(self, m):
+        return '%sServer_%s' % (self.name, code(m.name))
+
     def visit_Interface(self, i):
-        name = code(i.name)
+        self.name = name = code(i.name)
+        if self.support:
+            self.out(INDEX_SUPPORT)
+            self.out(OBSERVER_SUPPORT)
+            self.out(DISPATCH_SUPPORT)
         self.out('class %sServer {' % name)
         self.out.indent()
         self.out('%s impl;' % name)
-        with self.out.block('%sServer(%s impl)' % (name, name)):
-            self.out('self.impl = impl;')
-        self.out('Map<String,Object> call(String name, Map<String,Object> args) {')
-        self.out.indent()
-        self.out('int idx;')
-        self.out('Map<String,Object> map = new Map<String,Object>();')
-        self.out('List<Map<String,Object>> list = new List<Map<String,Object>>();')
+        self.out('IndexLog index = new IndexLog();')
+        self.out('Map<String,MethodHandler> handlers = new Map<String,MethodHandler>();')
+        self.out('CallObserver observer = null;')
+        self.out('List<String> queries = new List<String>();')
+        self.out('Map<String,List<String>> invalidates = new Map<String,List<String>>();')
+        with self.out.block('Map<String,Object> call(String name, Map<String,Object> args)'):
+            with self.out.block('if (handlers.contains(name))'):
+                with self.out.block('if (observer == null)'):
+                    self.out('return handlers[name].handle(args);')
+                self.out('observer.begin(name);')
+                self.out('Map<String,Object> result = handlers[name].handle(args);')
+                self.out('observer.end(name, result);')
+                self.out('return result;')
+            with self.out.block('if (name == "$index_snapshot")'):
+                self.out('return index.snapshot();')
+            with self.out.block('if (name == "$index_updates")'):
+                self.out('long since = args["since"];')
+                self.out('return index.updates(since);')
+            self.out('Map<String,Object> map = new Map<String,Object>();')
+            self.out('map["$status"] = 404;')
+            self.out('map["$error"] = "unknown method " + name;')
+            self.out('return map;')
 
     def visit_Method(self, m):
-        self.out('if (name == "%s") {' % code(m.name))
-        self.out.indent()
+        self.methods.append(m)
+        handler = self.handler_name(m)
+        self.handlers('class %s extends MethodHandler {' % handler)
+        self.handlers.indent()
+        self.handlers('%sServer server;' % self.name)
+        with self.handlers.block('%s(%sServer server)' % (handler, self.name)):
+            self.handlers('self.server = server;')
+        self.handlers('Map<String,Object> handle(Map<String,Object> args) {')
+        self.handlers.indent()
+        self.handlers('Map<String,Object> map = new Map<String,Object>();')
 
     def visit_Param(self, p):
-        self.out('%s %s_%s = args["%s"];' % (code(p.type),
+        self.handlers('%s %s_%s = args["%s"];' % (code(p.type),
                                                   code(p.callable.name),
                                                   code(p.name),
                                                   code(p.name)))
 
     def leave_Method(self, m):
+        out = self.handlers
         name = code(m.name)
         params = ", ".join(["%s_%s" % (name, code(p.name)) for p in m.params])
-        call = 'self.impl.%s(%s);' % (name, params)
+        call = 'server.impl.%s(%s);' % (name, params)
         rettype = code(m.type.path[0])
         if rettype == "void":
-            self.out(call)
+            out(call)
         else:
-            self.out('%s %s_result = %s' % (code(m.type), name, call))
+            out('%s %s_result = %s' % (code(m.type), name, call))
             if rettype == "List":
                 eltype = code(m.type.parameters[0])
-                self.out('idx  = 0;')
-                with self.out.block('while (idx < %s_result.size())' % name):
-                    self.out('list.add(%s_toMap(%s_result[idx]));' % (eltype, name))
-                    self.out('idx = idx + 1;')
-                self.out('map["$result"] = list;')
+                out('List<Map<String,Object>> list = new List<Map<String,Object>>();')
+                out('int idx = 0;')
+                with out.block('while (idx < %s_result.size())' % name):
+                    out('list.add(%s_toMap(%s_result[idx]));' % (eltype, name))
+                    out('idx = idx + 1;')
+                out('map["$result"] = list;')
             else:
-                self.out('map = %s_toMap(%s_result);' % (rettype, name))
-        self.out('map["$status"] = 200;')
-        self.out('return map;')
-        self.out.dedent()
-        self.out('}')
+                out('map = %s_toMap(%s_result);' % (rettype, name))
+            if self.get_annotation(m, "index"):
+                out('server.index.record("%s", args, map);' % name)
+                self.indexed.append(m)
+        out('map["$status"] = 200;')
+        out('return map;')
+        out.dedent()
+        out('}')
+        out.dedent()
+        out('}')
 
     def leave_Interface(self, i):
-        self.out('map["$status"] = 500;')
-        self.out('return map;')
-        self.out.dedent()
-        self.out('}')
+        with self.out.block('%sServer(%s impl)' % (self.name, self.name)):
+            self.out('self.impl = impl;')
+            for m in self.methods:
+                self.out('handlers["%s"] = new %s(self);' % (code(m.name), self.handler_name(m)))
+            for m in self.methods:
+                if self.get_annotation(m, "query"):
+                    self.out('queries.add("%s");' % code(m.name))
+                ann = self.get_annotation(m, "invalidates")
+                if ann is not None:
+                    self.out('invalidates["%s"] = new List<String>();' % code(m.name))
+                    for arg in ann.arguments:
+                        self.out('invalidates["%s"].add(%s);' % (code(m.name), code(arg)))
+        for m in self.indexed:
+            self.publisher(m)
+        self.indexed = []
+        self.methods = []
         self.out.dedent()
         self.out('}')
+        for line in self.handlers.destination.lines:
+            self.out(line)
+        self.handlers = Emitter()
+
+    def publisher(self, m):
+        """
+        Emit <method>_publish and <method>_retract so the implementation can
+        push index changes to clients without waiting for them to be called.
+        """
+        name = code(m.name)
+        params = code(m.params)
+        with self.out.block('Map<String,Object> %s_args(%s)' % (name, params)):
+            self.out('Map<String,Object> args = new Map<String,Object>();')
+            for p in m.params:
+                self.out('args["%s"] = %s;' % (code(p.name), code(p.name)))
+            self.out('return args;')
+        sep = ", " if m.params else ""
+        names = ", ".join(code(p.name) for p in m.params)
+        with self.out.block('void %s_publish(%s%s%s result)' % (name, params, sep, code(m.type))):
+            self.out('Map<String,Object> map = new Map<String,Object>();')
+            if code(m.type.path[0]) == "List":
+                eltype = code(m.type.parameters[0])
+                self.out('List<Map<String,Object>> list = new List<Map<String,Object>>();')
+                self.out('int idx = 0;')
+                with self.out.block('while (idx < result.size())'):
+                    self.out('list.add(%s_toMap(result[idx]));' % eltype)
+                    self.out('idx = idx + 1;')
+                self.out('map["$result"] = list;')
+            else:
+                self.out('map = %s_toMap(result);' % code(m.type))
+            self.out('index.record("%s", self.%s_args(%s), map);' % (name, name, names))
+        with self.out.block('void %s_retract(%s)' % (name, params)):
+            self.out('index.record("%s", self.%s_args(%s), null);' % (name, name, names))
@@ -0,0 +1,126 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client-side load balancing over several endpoints of one service.
+
+Each request goes to the better of two endpoints picked at random, by
+fewest requests outstanding or by latency EWMA weighted by the requests
+outstanding. Two random choices spread load nearly as well as always
+picking the best, without every client piling onto the same endpoint.
+
+An endpoint that fails max_failures requests in a row is ejected, and
+probed in the background until it answers again, at first after
+eject_time seconds and then at doubling intervals up to max_eject_time.
+While every endpoint is ejected, requests go to all of them regardless.
+"""
+
+import httplib, random, socket, threading, time, urlparse
+
+LEAST_OUTSTANDING = "least_outstanding"
+EWMA = "ewma"
+
+
+class Endpoint(object):
+
+    def __init__(self, url, pool):
+        self.url = url
+        self.base_path = urlparse.urlsplit(url).path.rstrip("/")
+        self.pool = pool
+        self.outstanding = 0
+        self.latency = None  # EWMA of successful requests, in seconds
+        self.failures = 0  # in a row
+        self.ejected = False
+
+    def __repr__(self):
+        return "Endpoint(%r)" % self.url
+
+
+def probe(endpoint):
+    """Healthy if the endpoint answers a GET of its URL with a status below 500"""
+    conn = endpoint.pool.connect()
+    try:
+        conn.request("GET", endpoint.base_path or "/")
+        return conn.getresponse().status < 500
+    except (httplib.HTTPException, socket.error):
+        return False
+    finally:
+        conn.close()
+
+
+class Balancer(object):
+
+    def __init__(self, endpoints, policy=EWMA, max_failures=3, eject_time=5.0, max_eject_time=60.0,
+                 probe=probe, alpha=0.3):
+        if policy not in (LEAST_OUTSTANDING, EWMA):
+            raise ValueError("unknown balancing policy %r" % policy)
+        self.endpoints = endpoints
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.probe = probe
+        self.alpha = alpha  # weight of the newest sample in the EWMA
+        self.lock = threading.Lock()
+
+    def cost(self, endpoint):
+        if self.policy == LEAST_OUTSTANDING:
+            return endpoint.outstanding
+        # An endpoint without a latency yet costs nothing, so it gets one
+        return (endpoint.latency or 0.0) * (endpoint.outstanding + 1)
+
+    def pick(self):
+        with self.lock:
+            live = [endpoint for endpoint in self.endpoints if not endpoint.ejected] or self.endpoints
+            if len(live) == 1:
+                return live[0]
+            first, second = random.sample(live, 2)
+            return first if self.cost(first) <= self.cost(second) else second
+
+    def begin(self, endpoint):
+        """Count a request to endpoint as outstanding; returns its start time"""
+        with self.lock:
+            endpoint.outstanding += 1
+        return time.time()
+
+    def end(self, endpoint, started, failed):
+        elapsed = time.time() - started
+        with self.lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.failures = 0
+                if endpoint.latency is None:
+                    endpoint.latency = elapsed
+                else:
+                    endpoint.latency += self.alpha * (elapsed - endpoint.latency)
+                return
+            endpoint.failures += 1
+            if endpoint.ejected or endpoint.failures < self.max_failures:
+                return
+            endpoint.ejected = True
+        prober = threading.Thread(target=self.recover, args=(endpoint,), name="rpc-probe")
+        prober.daemon = True
+        prober.start()
+
+    def recover(self, endpoint):
+        delay = self.eject_time
+        while True:
+            time.sleep(delay)
+            if self.probe(endpoint):
+                break
+            delay = min(delay * 2, self.max_eject_time)
+        with self.lock:
+            endpoint.ejected = False
+            endpoint.failures = 0
+            endpoint.latency = None  # Stale; the next requests measure it again
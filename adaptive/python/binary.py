@@ -0,0 +1,286 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact binary alternative to the JSON encoding in runtime.
+
+A message is a version byte, a type table, and one value. The type table
+lists every record type used in the message once: the class name and slot
+names of an AdaptiveValueType, or the keys of a dict whose keys are all
+strings (the maps produced by the generated toMap functions). Records
+then carry only a type id and their field values in order. Integers are
+zigzag varints and strings are length-prefixed UTF-8.
+"""
+
+import struct, collections
+
+from runtime import AdaptiveValueType, CLASS_KEY, slot_names, adaptive_object_hook
+
+CONTENT_TYPE = "application/x-adaptive-binary"
+
+VERSION = 1
+
+# Value tags
+NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, DICT, RECORD = range(9)
+
+# Type table entry kinds
+CLASS, SHAPE = range(2)
+
+_double = struct.Struct(">d")
+
+
+class BinaryFormatError(ValueError):
+    pass
+
+
+def _varint(n, append):
+    while n > 0x7f:
+        append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    append(chr(n))
+
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+
+class Encoder(object):
+
+    def __init__(self):
+        self.out = []
+        self.types = {}  # class or tuple of keys -> type id
+        self.table = []  # (kind, name, field names)
+        self.writers = {
+            type(None): self.none,
+            bool: self.bool,
+            int: self.int,
+            long: self.int,
+            float: self.float,
+            str: self.str,
+            unicode: self.str,
+            list: self.list,
+            tuple: self.list,
+            dict: self.dict,
+        }
+
+    def type_id(self, key, kind, name, fields):
+        type_id = self.types.get(key)
+        if type_id is None:
+            type_id = self.types[key] = len(self.table)
+            self.table.append((kind, name, fields))
+        return type_id
+
+    def string(self, value, append):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        _varint(len(value), append)
+        append(value)
+
+    def value(self, value):
+        writer = self.writers.get(value.__class__)
+        if writer is None:
+            writer = self.writer_for(value)
+        writer(value)
+
+    def writer_for(self, value):
+        if isinstance(value, AdaptiveValueType):
+            writer = self.record
+        elif isinstance(value, collections.Sequence) and not isinstance(value, basestring):
+            writer = self.list  # e.g. a lazy.LazyList
+        else:
+            for base, writer in self.writers.items():
+                if base is not bool and isinstance(value, base):
+                    break
+            else:
+                raise TypeError("%r is not serializable" % (value,))
+        self.writers[value.__class__] = writer
+        return writer
+
+    def none(self, value):
+        self.out.append(chr(NONE))
+
+    def bool(self, value):
+        self.out.append(chr(TRUE) if value else chr(FALSE))
+
+    def int(self, value):
+        self.out.append(chr(INT))
+        _varint(_zigzag(value), self.out.append)
+
+    def float(self, value):
+        self.out.append(chr(FLOAT) + _double.pack(value))
+
+    def str(self, value):
+        self.out.append(chr(STR))
+        self.string(value, self.out.append)
+
+    def list(self, value):
+        self.out.append(chr(LIST))
+        _varint(len(value), self.out.append)
+        for item in value:
+            self.value(item)
+
+    def dict(self, value):
+        append = self.out.append
+        keys = tuple(value)
+        if all(isinstance(key, basestring) for key in keys):
+            append(chr(RECORD))
+            _varint(self.type_id(keys, SHAPE, "", keys), append)
+            for key in keys:
+                self.value(value[key])
+        else:
+            append(chr(DICT))
+            _varint(len(value), append)
+            for key, item in value.iteritems():
+                self.value(key)
+                self.value(item)
+
+    def record(self, value):
+        cls = getattr(value, "__lazy_base__", value.__class__)
+        append = self.out.append
+        append(chr(RECORD))
+        _varint(self.type_id(cls, CLASS, cls.__name__, slot_names(cls)), append)
+        for item in value.__adaptive_values__():
+            self.value(item)
+
+    def message(self):
+        body, self.out = self.out, []
+        append = self.out.append
+        append(chr(VERSION))
+        _varint(len(self.table), append)
+        for kind, name, fields in self.table:
+            append(chr(kind))
+            self.string(name, append)
+            _varint(len(fields), append)
+            for field in fields:
+                self.string(field, append)
+        return "".join(self.out + body)
+
+
+def serialize(obj):
+    encoder = Encoder()
+    encoder.value(obj)
+    return encoder.message()
+
+
+class Decoder(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.bytes = bytearray(data)
+        self.pos = 0
+        self.table = []  # (kind, builder or None, name, field names)
+
+    def byte(self):
+        try:
+            value = self.bytes[self.pos]
+        except IndexError:
+            raise BinaryFormatError("truncated message")
+        self.pos += 1
+        return value
+
+    def varint(self):
+        result = shift = 0
+        while True:
+            byte = self.byte()
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def string(self):
+        length = self.varint()
+        start = self.pos
+        self.pos += length
+        if self.pos > len(self.bytes):
+            raise BinaryFormatError("truncated message")
+        return self.data[start:self.pos].decode("utf-8")
+
+    def header(self):
+        if self.byte() != VERSION:
+            raise BinaryFormatError("unsupported version")
+        for _ in range(self.varint()):
+            kind = self.byte()
+            name = self.string()
+            fields = tuple(self.string() for _ in range(self.varint()))
+            builder = None
+            if kind == CLASS:
+                cls = AdaptiveValueType.__known_subclasses__.get(name)
+                # Only trust the positional layout if both ends agree on it.
+                if cls is not None and slot_names(cls) == fields:
+                    builder = AdaptiveValueType.__known_builders__[name]
+            elif kind != SHAPE:
+                raise BinaryFormatError("unknown type kind %d" % kind)
+            self.table.append((kind, builder, name, fields))
+
+    def value(self):
+        return self.readers[self.byte()](self)
+
+    def none(self):
+        return None
+
+    def true(self):
+        return True
+
+    def false(self):
+        return False
+
+    def int(self):
+        n = self.varint()
+        return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+    def float(self):
+        start = self.pos
+        self.pos += 8
+        if self.pos > len(self.bytes):
+            raise BinaryFormatError("truncated message")
+        return _double.unpack_from(self.data, start)[0]
+
+    def list(self):
+        return [self.value() for _ in xrange(self.varint())]
+
+    def dict(self):
+        result = {}
+        for _ in xrange(self.varint()):
+            key = self.value()
+            result[key] = self.value()
+        return result
+
+    def record(self):
+        try:
+            kind, builder, name, fields = self.table[self.varint()]
+        except IndexError:
+            raise BinaryFormatError("undeclared type")
+        values = [self.value() for _ in fields]
+        if builder is not None:
+            return builder(values)
+        result = dict(zip(fields, values))
+        if kind == CLASS:
+            result[CLASS_KEY] = name
+            return adaptive_object_hook(result)
+        return result
+
+    def unknown(self):
+        raise BinaryFormatError("unknown tag %d" % self.bytes[self.pos - 1])
+
+    # Indexed by tag
+    readers = [none, false, true, int, float, string, list, dict, record] + [unknown] * 247
+
+
+def deserialize(data):
+    decoder = Decoder(data)
+    decoder.header()
+    result = decoder.value()
+    if decoder.pos != len(decoder.bytes):
+        raise BinaryFormatError("trailing data")
+    return result
@@ -0,0 +1,106 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Call deadlines.
+
+A deadline is the time after which nobody is waiting for a result. Calls
+made within a deadline give up when it passes, and send the time that is
+left in the X-Deadline-Ms header:
+
+    with deadlines.within(0.25):
+        pet = client.findPetById(id)
+
+Servers make the deadline of the request being handled current, so that
+they skip methods whose caller has already given up and calls made on
+its behalf inherit what is left of it.
+"""
+
+import contextlib, threading, time
+
+DEADLINE_HEADER = "X-Deadline-Ms"  # milliseconds the caller will still wait
+
+_context = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def current():
+    """Deadline of this thread as a time.time() value, or None"""
+    return getattr(_context, "deadline", None)
+
+
+def set_deadline(deadline):
+    _context.deadline = deadline
+
+
+def remaining():
+    """Seconds left before the current deadline, or None"""
+    deadline = current()
+    return None if deadline is None else deadline - time.time()
+
+
+def expired():
+    deadline = current()
+    return deadline is not None and time.time() >= deadline
+
+
+@contextlib.contextmanager
+def within(seconds):
+    """
+    Make the deadline seconds from now, unless the current one is earlier.
+    With seconds None, the current deadline stays as it is.
+    """
+    outer = current()
+    if seconds is None:
+        yield
+        return
+    deadline = time.time() + seconds
+    if outer is not None and outer < deadline:
+        deadline = outer
+    set_deadline(deadline)
+    try:
+        yield
+    finally:
+        set_deadline(outer)
+
+
+def to_header():
+    """Value of DEADLINE_HEADER for the current deadline, or None"""
+    left = remaining()
+    if left is None:
+        return None
+    if left <= 0:
+        raise DeadlineExceeded("deadline passed before the call was sent")
+    return str(max(1, int(left * 1000)))
+
+
+def wait(event, deadline):
+    """event.wait() that raises DeadlineExceeded once deadline, if any, has passed"""
+    if deadline is None:
+        event.wait()
+    elif not event.wait(max(0, deadline - time.time())):
+        raise DeadlineExceeded("no response before the deadline")
+
+
+def from_header(value, now=None):
+    """Deadline a DEADLINE_HEADER value received at now stands for, or None"""
+    if not value:
+        return None
+    try:
+        return (now or time.time()) + int(value) / 1000.0
+    except ValueError:
+        return None
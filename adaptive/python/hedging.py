@@ -0,0 +1,109 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Hedged requests for idempotent calls.
+
+A hedged call sends a second, identical request when the first has taken
+longer than most calls of the same method do, and returns whichever
+answers first. The delay is the given percentile of the method's recent
+latencies, so only the slowest few calls cost a second request. Until a
+method has min_samples latencies, its calls are not hedged.
+"""
+
+import collections, sys, threading, time, Queue
+
+import deadlines, tracing
+
+
+class Hedger(object):
+
+    def __init__(self, percentile=95, window=200, min_samples=20):
+        self.percentile = percentile
+        self.window = window  # latencies kept per method
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.latencies = {}  # method -> deque of seconds
+
+    def record(self, name, seconds):
+        with self.lock:
+            latencies = self.latencies.get(name)
+            if latencies is None:
+                latencies = self.latencies[name] = collections.deque(maxlen=self.window)
+            latencies.append(seconds)
+
+    def delay(self, name):
+        """Seconds to wait before hedging a call of name, or None not to hedge"""
+        with self.lock:
+            latencies = self.latencies.get(name)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * self.percentile // 100)]
+
+    def timed(self, name, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.record(name, time.time() - start)
+        return result
+
+    def call(self, name, func, *args):
+        """
+        Return func(*args), calling it a second time if the first call is
+        slow. The first successful result wins; if both calls fail, the
+        error of the last one is raised.
+        """
+        delay = self.delay(name)
+        if delay is None:
+            return self.timed(name, func, *args)
+        results = Queue.Queue()
+        self.attempt(results, name, func, args)
+        left = deadlines.remaining()
+        try:
+            okay, value = results.get(timeout=delay if left is None else max(0, min(delay, left)))
+        except Queue.Empty:
+            self.attempt(results, name, func, args)
+            okay, value = self.wait(results)
+            if not okay:
+                okay, value = self.wait(results)
+        if not okay:
+            raise value[0], value[1], value[2]
+        return value
+
+    def attempt(self, results, name, func, args):
+        # The deadline and trace id are per thread, so carry them over.
+        deadline, trace_id = deadlines.current(), tracing.current_trace_id()
+
+        def run():
+            deadlines.set_deadline(deadline)
+            tracing.set_trace_id(trace_id)
+            try:
+                results.put((True, self.timed(name, func, *args)))
+            except Exception:
+                results.put((False, sys.exc_info()))
+        thread = threading.Thread(target=run, name="rpc-hedge")
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, results):
+        left = deadlines.remaining()
+        if left is None:
+            return results.get()
+        try:
+            return results.get(timeout=max(0, left))
+        except Queue.Empty:
+            try:
+                raise deadlines.DeadlineExceeded("no response before the deadline")
+            except deadlines.DeadlineExceeded:
+                return False, sys.exc_info()
@@ -0,0 +1,256 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+On-access decoding of JSON encoded values.
+
+deserialize returns what runtime.deserialize would, except that arrays
+become LazyLists, and flat objects tagged with a known AdaptiveValue
+class become instances of a lazy subclass of that class. A LazyList
+scans its text only as far as it has been read. A lazy value keeps the
+span of text it came from, and decodes it the first time a field is
+read or written.
+
+Results may be shared between threads, so scanning and decoding a value
+hold a lock, one for all documents as they are mostly read by one thread.
+"""
+
+import re, json, threading, collections
+
+import runtime
+from runtime import AdaptiveValueType, CLASS_KEY, slot_names, _decoder
+
+# Text up to the next bracket, skipping over strings
+_RUN = r'[^\[\]{}"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^\[\]{}"]*)*'
+_TO_BRACKET = re.compile(_RUN)
+_FLAT_OBJECT = re.compile(r'\{%s\}' % _RUN)
+_FLAT_ITEM = re.compile(r'(\{%s\})\s*([,\]])\s*' % _RUN)  # and the separator after it
+_SEPARATOR = re.compile(r'\s*([,\]])\s*')
+_WHITESPACE = re.compile(r'\s*')
+_CLASS = re.compile(r'"%s"\s*:\s*"([^"\\]*)"' % CLASS_KEY)
+
+# Flat objects hold no nested values, so they need no object hook
+_scan_plain = json.JSONDecoder().scan_once
+
+_lock = threading.RLock()  # reentrant, as skipping a list skips the lists in it
+
+
+def plain_value(data, pos):
+    try:
+        return _scan_plain(data, pos)[0]
+    except StopIteration:
+        raise ValueError("Malformed JSON at %d" % pos)
+
+
+def container_end(data, pos, depth=0):
+    """
+    Return the end of the array or object starting at data[pos], or, with
+    depth, of the one that many levels out from an item starting at pos.
+    """
+    if depth:
+        pos = _TO_BRACKET.match(data, pos).end()
+    while True:
+        char = data[pos:pos + 1]
+        if char == "[" or char == "{":
+            depth += 1
+        elif char == "]" or char == "}":
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        else:
+            raise ValueError("Malformed JSON at %d" % pos)
+        pos = _TO_BRACKET.match(data, pos + 1).end()
+
+
+def decode_at(data, pos):
+    """
+    Decode the value starting at data[pos], lazily where possible. Return it
+    and its end, which is None for a LazyList.
+    """
+    char = data[pos:pos + 1]
+    if char == "[":
+        return LazyList(data, pos), None
+    if char == "{":
+        match = _FLAT_OBJECT.match(data, pos)
+        if match is not None:
+            end = match.end()
+            return flat_object(data, pos, end), end
+    return _decoder.raw_decode(data, pos)
+
+
+def flat_object(data, pos, end):
+    match = _CLASS.search(data, pos, end)
+    lazy = match and lazy_classes[match.group(1)]
+    if lazy:
+        value = lazy.__new__(lazy)
+        value.__span__ = data, pos
+        return value
+    return plain_value(data, pos)
+
+
+class LazyList(collections.Sequence):
+
+    """
+    Items are decoded as they are first read. Errors in the text are
+    reported when the part that holds them is read, not up front.
+    """
+
+    def __init__(self, data, start):
+        self.data = data
+        self.items = []
+        self.end = None
+        # Where the next item starts; or the previous item, if that is a
+        # LazyList whose end is not known yet; or None after the last item.
+        self.pos = _WHITESPACE.match(data, start + 1).end()
+        if data[self.pos:self.pos + 1] == "]":
+            self.end = self.pos + 1
+            self.pos = None
+
+    def after(self, pos):
+        # Position of the item after the one ending at pos, if any
+        match = _SEPARATOR.match(self.data, pos)
+        if match is None:
+            raise ValueError("Malformed JSON at %d" % pos)
+        if match.group(1) == "]":
+            self.end = match.end(1)
+            return None
+        return match.end()
+
+    def scan(self, count):
+        """Decode items until there are count of them or the list is exhausted"""
+        with _lock:
+            data, items, pos = self.data, self.items, self.pos
+            while pos is not None and len(items) < count:
+                if type(pos) is LazyList:  # Not isinstance, which is slow for an ABC
+                    pos = self.after(pos.skip())
+                    continue
+                match = _FLAT_ITEM.match(data, pos)
+                if match is not None:  # The common case, in one match
+                    items.append(flat_object(data, pos, match.end(1)))
+                    if match.group(2) == "]":
+                        self.end = match.end(2)
+                        pos = None
+                    else:
+                        pos = match.end()
+                    continue
+                item, end = decode_at(data, pos)
+                items.append(item)
+                pos = item if end is None else self.after(end)
+            self.pos = pos
+
+    def skip(self):
+        """Return the end of the list in the text, without decoding the items left"""
+        with _lock:
+            if self.end is None:
+                pos = self.pos
+                if type(pos) is LazyList:
+                    self.end = container_end(self.data, pos.skip(), 1)
+                else:
+                    self.end = container_end(self.data, pos, 1)
+            return self.end
+
+    def __len__(self):
+        if self.pos is not None:
+            self.scan(len(self.data))
+        return len(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or index < 0:
+            self.scan(len(self.data))
+        elif index >= len(self.items):
+            self.scan(index + 1)
+        return self.items[index]
+
+    def __iter__(self):
+        idx = 0
+        while True:
+            if idx >= len(self.items):
+                self.scan(idx + 1)
+                if idx >= len(self.items):
+                    return
+            yield self.items[idx]
+            idx += 1
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return "LazyList(%r)" % list(self)
+
+
+def lazy_class(cls):
+    """
+    Subclass of cls whose slots are properties over cls's own slots,
+    filled from __span__ on first access.
+    """
+    members = [(name, getattr(cls, name)) for name in slot_names(cls)]
+
+    def load(self):
+        # The slots are filled before __span__ is cleared, which readers in
+        # other threads check without the lock.
+        with _lock:
+            if self.__span__ is None:
+                return
+            data, pos = self.__span__
+            value = plain_value(data, pos)
+            for name, member in members:
+                if name in value:  # Slots missing from the text stay unset
+                    member.__set__(self, value[name])
+            self.__span__ = None
+
+    def slot(member):
+        def get(self):
+            if self.__span__ is not None:
+                load(self)
+            return member.__get__(self, cls)
+
+        def set(self, value):
+            if self.__span__ is not None:
+                load(self)
+            member.__set__(self, value)
+        return property(get, set)
+
+    namespace = dict((name, slot(member)) for name, member in members)
+    namespace["__slots__"] = ("__span__",)
+    namespace["__lazy_base__"] = cls
+    return type("Lazy" + cls.__name__, (cls,), namespace)
+
+
+class LazyClasses(dict):
+    # name -> lazy subclass of the AdaptiveValue class, made on first use
+
+    def __missing__(self, name):
+        cls = AdaptiveValueType.__known_subclasses__.get(name)
+        if cls is None:
+            return None
+        lazy = self[name] = lazy_class(cls)
+        return lazy
+
+lazy_classes = LazyClasses()
+
+
+def deserialize(data):
+    if runtime._ref_marker in data:  # Shared references need the whole document
+        return runtime.deserialize(data)
+    pos = _WHITESPACE.match(data).end()
+    value, end = decode_at(data, pos)
+    if end is not None and _WHITESPACE.match(data, end).end() != len(data):
+        raise ValueError("Extra data at %d" % end)
+    return value
@@ -0,0 +1,173 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-method server metrics, rendered in the Prometheus text format.
+
+For each service and method the registry counts calls and errors by
+exception class, and keeps histograms of the time spent decoding the
+request, in the implementation and encoding the response, and of the
+request and response sizes on the wire.
+"""
+
+import bisect, threading, time
+
+SECONDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+PHASES = "decode", "impl", "encode"
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Histogram(object):
+    # Not locked; MethodStats records under its own lock
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last is above every bound
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        """Yield (le, cumulative count), ending with ("+Inf", total)"""
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            yield repr(bound), total
+        yield "+Inf", total + self.counts[-1]
+
+
+class MethodStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = {}  # exception class name -> count
+        self.phases = dict((phase, Histogram(SECONDS)) for phase in PHASES)
+        self.request_bytes = Histogram(BYTES)
+        self.response_bytes = Histogram(BYTES)
+
+    def record(self, decode=None, impl=None, encode=None, request_bytes=None, response_bytes=None,
+               error=None):
+        """Record one call. Times are in seconds; what was not measured is None."""
+        with self.lock:
+            self.calls += 1
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            for phase, value in zip(PHASES, (decode, impl, encode)):
+                if value is not None:
+                    self.phases[phase].observe(value)
+            if request_bytes is not None:
+                self.request_bytes.observe(request_bytes)
+            if response_bytes is not None:
+                self.response_bytes.observe(response_bytes)
+
+
+def labels(**values):
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for name, value in sorted(values.items()))
+
+
+def histogram_lines(name, histogram, **values):
+    for le, count in histogram.samples():
+        yield "%s_bucket{%s} %d" % (name, labels(le=le, **values), count)
+    yield "%s_sum{%s} %r" % (name, labels(**values), histogram.sum)
+    yield "%s_count{%s} %d" % (name, labels(**values), sum(histogram.counts))
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}  # (service, method) -> MethodStats
+        self.rejected = {}  # HTTP status -> requests refused before reaching a method
+
+    def method(self, service, method):
+        key = service, method
+        stats = self.methods.get(key)
+        if stats is None:
+            with self.lock:
+                stats = self.methods.setdefault(key, MethodStats())
+        return stats
+
+    def reject(self, status):
+        with self.lock:
+            self.rejected[status] = self.rejected.get(status, 0) + 1
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        with self.lock:
+            methods = sorted(self.methods.items())
+            rejected = sorted(self.rejected.items())
+        lines = []
+        for name, kind, doc, sample in FAMILIES:
+            lines.append("# HELP %s %s" % (name, doc))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (service, method), stats in methods:
+                with stats.lock:
+                    lines.extend(sample(name, stats, {"service": service, "method": method}))
+        lines.append("# HELP adaptive_rpc_rejected_total Requests refused before reaching a method, by status.")
+        lines.append("# TYPE adaptive_rpc_rejected_total counter")
+        for status, count in rejected:
+            lines.append("adaptive_rpc_rejected_total{%s} %d" % (labels(status=status), count))
+        return "\n".join(lines) + "\n"
+
+
+def phase_lines(name, stats, values):
+    for phase in PHASES:
+        for line in histogram_lines(name, stats.phases[phase], phase=phase, **values):
+            yield line
+
+FAMILIES = [
+    ("adaptive_rpc_calls_total", "counter", "Calls by service and method.",
+     lambda name, stats, values: ["%s{%s} %d" % (name, labels(**values), stats.calls)]),
+    ("adaptive_rpc_errors_total", "counter", "Calls that failed, by exception class.",
+     lambda name, stats, values: ["%s{%s} %d" % (name, labels(exception=error, **values), count)
+                                  for error, count in sorted(stats.errors.items())]),
+    ("adaptive_rpc_seconds", "histogram", "Time per call spent decoding, in the implementation and encoding.",
+     phase_lines),
+    ("adaptive_rpc_request_bytes", "histogram", "Request size on the wire.",
+     lambda name, stats, values: histogram_lines(name, stats.request_bytes, **values)),
+    ("adaptive_rpc_response_bytes", "histogram", "Response size on the wire.",
+     lambda name, stats, values: histogram_lines(name, stats.response_bytes, **values)),
+]
+
+
+class CallObserver(object):
+    """
+    Host side of the CallObserver interface of generated servers, which
+    reports the time each dispatched call spends in the implementation.
+    """
+
+    def __init__(self, registry, service):
+        self.registry = registry
+        self.service = service
+        self.local = threading.local()
+
+    def begin(self, name):
+        self.local.start = time.time()
+
+    def end(self, name, result):
+        # Quark has no exceptions; failures come back as a status
+        error = None
+        if result is not None and result.get("$status", 200) != 200:
+            error = "status %s" % result.get("$status")
+        self.registry.method(self.service, name).record(impl=time.time() - self.local.start, error=error)
+
+
+REGISTRY = Registry()
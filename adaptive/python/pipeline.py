@@ -0,0 +1,267 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pipelined client for fanning out many concurrent calls without a thread
+per call in flight.
+
+A single I/O thread runs a select loop over a few keep-alive connections.
+Requests are written as they are submitted, without waiting for the
+responses to earlier ones (HTTP/1.1 pipelining), and responses are
+matched to requests in order. Callers get a Future per call:
+
+    client = PipelinedClient("http://127.0.0.1:8080/PetStore")
+    futures = [client.call_async("findPetById", [id], True) for id in ids]
+    pets = [future.result() for future in futures]
+
+Only responses with a Content-Length, or that end with the connection,
+are understood, so results cannot be streamed this way.
+"""
+
+import collections, errno, os, select, socket, sys, threading, urllib2, urlparse
+
+import tracing, deadlines
+from sample_rpc import JSON, CODECS, CONTENT_TYPE, Future, call_to_body, decompress, unpack_output
+
+_RETRYABLE = errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR
+
+
+class Request(object):
+
+    def __init__(self, name, data, idempotent):
+        self.name = name
+        self.data = data
+        self.idempotent = idempotent
+        self.future = Future()
+        self.attempts = 0
+
+
+class Connection(object):
+
+    def __init__(self, address, timeout):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.outbuf = ""
+        self.inbuf = ""
+        self.pending = collections.deque()  # written or queued for writing, in order
+        self.head = None  # (status, reason, headers) of the response being read
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class PipelinedClient(object):
+    """
+    At most connections connections are opened, each with at most
+    max_pipeline requests outstanding; further calls wait their turn.
+    """
+
+    def __init__(self, url, connections=4, max_pipeline=64, codec=JSON, compression=True, timeout=None):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError("pipelining is only supported over http: %r" % url)
+        self.url = url
+        self.address = parts.hostname, parts.port or 80
+        self.path = parts.path.rstrip("/") or "/"
+        self.codec = codec
+        self.headers = "Host: %s\r\nContent-Type: %s\r\nAccept: %s\r\n" % (
+            parts.netloc, codec.content_type, codec.content_type +
+            ("" if codec.content_type == CONTENT_TYPE else ", " + CONTENT_TYPE))
+        if compression:
+            self.headers += "Accept-Encoding: gzip, deflate\r\n"
+        self.max_connections = connections
+        self.max_pipeline = max_pipeline
+        self.timeout = timeout
+        self.connections = []
+        self.submitted = collections.deque()  # appended to by callers, taken by the loop
+        self.closed = False
+        self.wake_read, self.wake_write = os.pipe()
+        self.thread = threading.Thread(target=self.run, name="rpc-pipeline")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def call_async(self, name, args, idempotent=False):
+        """
+        Future of the result of calling name. Idempotent calls are retried
+        once if their connection fails before the response arrives.
+        """
+        if self.closed:
+            raise RuntimeError("client is closed")
+        body = call_to_body(name, args, self.codec)
+        headers = self.headers
+        trace_id = tracing.current_trace_id()
+        if trace_id:
+            headers += "%s: %s\r\n" % (tracing.TRACE_HEADER, trace_id)
+        deadline = deadlines.to_header()
+        if deadline:
+            headers += "%s: %s\r\n" % (deadlines.DEADLINE_HEADER, deadline)
+        data = "POST %s HTTP/1.1\r\n%sContent-Length: %d\r\n\r\n%s" % (self.path, headers, len(body), body)
+        request = Request(name, data, idempotent)
+        self.submitted.append(request)
+        self.wake()
+        return request.future
+
+    def call(self, name, args):
+        return self.call_async(name, args).result()
+
+    def fetch(self, name, args):
+        return self.call_async(name, args, True).result()
+
+    def close(self):
+        """Fail the calls still outstanding and stop the I/O thread"""
+        self.closed = True
+        self.wake()
+        self.thread.join()
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, "x")
+        except OSError:  # The pipe is full, so the loop will wake anyway
+            pass
+
+    # The rest runs on the I/O thread
+
+    def run(self):
+        try:
+            while not self.closed:
+                self.assign()
+                writers = [conn for conn in self.connections if conn.outbuf]
+                readable, writable, _ = select.select([self.wake_read] + self.connections, writers, [])
+                if self.wake_read in readable:
+                    os.read(self.wake_read, 4096)
+                for conn in writable:
+                    self.write(conn)
+                for conn in readable:
+                    if conn is not self.wake_read and conn in self.connections:
+                        self.read(conn)
+        finally:
+            self.closed = True
+            error = RuntimeError("client is closed")
+            for conn in list(self.connections):
+                self.drop(conn, error, retry=False)
+            while self.submitted:
+                self.fail(self.submitted.popleft(), error)
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+
+    def assign(self):
+        while self.submitted:
+            conn = min(self.connections, key=lambda conn: len(conn.pending)) if self.connections else None
+            if conn is None or len(conn.pending) >= self.max_pipeline:
+                if len(self.connections) < self.max_connections:
+                    try:
+                        conn = Connection(self.address, self.timeout)
+                    except socket.error:
+                        self.fail(self.submitted.popleft(), sys.exc_info())
+                        continue
+                    self.connections.append(conn)
+                elif conn is None or len(conn.pending) >= self.max_pipeline:
+                    return
+            request = self.submitted.popleft()
+            request.attempts += 1
+            conn.pending.append(request)
+            conn.outbuf += request.data
+
+    def write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as exc:
+            if exc.errno not in _RETRYABLE:
+                self.drop(conn, sys.exc_info())
+            return
+        conn.outbuf = conn.outbuf[sent:]
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error as exc:
+            if exc.errno not in _RETRYABLE:
+                self.drop(conn, sys.exc_info())
+            return
+        if not data:
+            if conn.head is not None and "content-length" not in conn.head[2]:
+                self.complete(conn, conn.inbuf)  # The body ran to the end of the connection
+            if conn in self.connections:
+                self.drop(conn, socket.error(errno.ECONNRESET, "connection closed by server"))
+            return
+        conn.inbuf += data
+        while conn in self.connections and self.parse(conn):
+            pass
+
+    def parse(self, conn):
+        """Complete the next response if all of it has arrived, and say if it had"""
+        if conn.head is None:
+            end = conn.inbuf.find("\r\n\r\n")
+            if end < 0:
+                return False
+            lines = conn.inbuf[:end].split("\r\n")
+            conn.inbuf = conn.inbuf[end + 4:]
+            status = lines[0].split(" ", 2) + [""]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if "chunked" in headers.get("transfer-encoding", ""):
+                self.drop(conn, ValueError("chunked responses are not supported"))
+                return False
+            conn.head = int(status[1]), status[2], headers
+        length = conn.head[2].get("content-length")
+        if length is None or len(conn.inbuf) < int(length):
+            return False
+        body, conn.inbuf = conn.inbuf[:int(length)], conn.inbuf[int(length):]
+        self.complete(conn, body)
+        return True
+
+    def complete(self, conn, body):
+        status, reason, headers = conn.head
+        conn.head = None
+        request = conn.pending.popleft()
+        try:
+            if status != 200:
+                raise urllib2.HTTPError(self.url, status, reason, headers, None)
+            data = decompress(body, headers.get("content-encoding"))
+            content_type = headers.get("content-type", CONTENT_TYPE).split(";")[0].strip()
+            output = CODECS.get(content_type, JSON).deserialize(data)
+            request.future.set_result(unpack_output(output[0], output[1]))
+        except Exception:
+            request.future.set_exception(sys.exc_info())
+        if headers.get("connection", "").lower() == "close":
+            # The server read nothing after this request, so the rest are
+            # safe to send again whatever they do.
+            self.drop(conn, None)
+
+    def drop(self, conn, error, retry=True):
+        """
+        Close conn. Requests still pending on it are sent again if that is
+        safe (error is None, or they are idempotent and were only tried
+        once) and fail with error otherwise.
+        """
+        self.connections.remove(conn)
+        conn.sock.close()
+        retried = []
+        for request in conn.pending:
+            if retry and (error is None or (request.idempotent and request.attempts < 2)):
+                retried.append(request)
+            else:
+                self.fail(request, error)
+        self.submitted.extendleft(reversed(retried))
+
+    def fail(self, request, error):
+        if not isinstance(error, tuple):
+            try:
+                raise error
+            except Exception:
+                error = sys.exc_info()
+        request.future.set_exception(error)
@@ -0,0 +1,81 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Server-side cache of encoded query results.
+
+Generated servers list their @query methods in queries, and the queries
+each @operation declared with @invalidates("query", ...) affects in
+invalidates. With ServiceRequestHandler.result_cache set, the response to
+a query is kept as the bytes sent, so that the same call is answered again
+without running the method or encoding its result. When any other method
+of the service succeeds, the entries of the queries it declared are
+dropped, or all of the service's entries if it declared none.
+"""
+
+import collections, threading
+
+
+class ResultCache(object):
+    """At most max_entries responses are kept, the least recently used going first"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> response, oldest first
+        self.keys = {}  # (service, method) -> set of keys
+        self.generations = {}  # service -> number of invalidations
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, service):
+        """Pass to put, so that a result computed before an invalidation is not kept"""
+        with self.lock:
+            return self.generations.get(service, 0)
+
+    def get(self, key):
+        """key is (service, method, ...); returns the response put for it, or None"""
+        with self.lock:
+            response = self.entries.pop(key, None)
+            if response is None:
+                self.misses += 1
+                return None
+            self.entries[key] = response
+            self.hits += 1
+            return response
+
+    def put(self, key, response, generation):
+        with self.lock:
+            if self.generations.get(key[0], 0) != generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = response
+            self.keys.setdefault(key[:2], set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.forget(self.entries.popitem(last=False)[0])
+
+    def forget(self, key):
+        keys = self.keys[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self.keys[key[:2]]
+
+    def invalidate(self, service, methods=None):
+        """Drop the entries of service's methods, or of all of them"""
+        with self.lock:
+            self.generations[service] = self.generations.get(service, 0) + 1
+            for pair in list(self.keys):
+                if pair[0] == service and (not methods or pair[1] in methods):
+                    for key in self.keys.pop(pair):
+                        del self.entries[key]
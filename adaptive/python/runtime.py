@@ -12,65 +12,238 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import json, functools, collections
+
+CLASS_KEY = "__adaptive_class_name__"
+ID_KEY = "__adaptive_id__"  # on a value that is referred to again later
+REF_KEY = "__adaptive_ref__"  # {REF_KEY: id} stands for the value with that id
 
 
 class AdaptiveValueType(object):
     __slots__ = ()
     __known_subclasses__ = {}  # name -> class
+    __known_decoders__ = {}  # name -> decode function, see compile_codecs
+    __known_builders__ = {}  # name -> build function, see compile_codecs
 
     def __eq__(self, other):
-        if self.__class__ != other.__class__:
+        # Compare lazily decoded values (see lazy.py) as their base class
+        cls = getattr(self, "__lazy_base__", self.__class__)
+        if cls != getattr(other, "__lazy_base__", other.__class__):
             return False
-        for slot_name in self.__slots__:
+        for slot_name in slot_names(cls):
             if getattr(self, slot_name) != getattr(other, slot_name):
                 return False
         return True
 
-    def __to_jsonable__(self):
-        # FIXME: Detect object cycles to avoid infinite recursion
-        res = {"__adaptive_class_name__": self.__class__.__name__}
-        for slot_name in self.__slots__:
-            value = getattr(self, slot_name)
-            if isinstance(value, AdaptiveValueType):
-                res[slot_name] = value.__to_jsonable__()
-            else:
-                res[slot_name] = value
+    def __ne__(self, other):
+        # Python 2 does not derive != from __eq__, and __eq__ compares
+        # nested values with it.
+        return not self.__eq__(other)
+
+    def __adaptive_encode__(self):
+        # Shallow encoding: nested values are left for the JSON encoder.
+        # AdaptiveValue replaces this with a version compiled for the class.
+        res = {CLASS_KEY: self.__class__.__name__}
+        for slot_name in slot_names(self.__class__):
+            res[slot_name] = getattr(self, slot_name)
         return res
 
+    def __adaptive_values__(self):
+        # Slot values in order; AdaptiveValue also compiles this for the class.
+        return tuple(getattr(self, slot_name) for slot_name in slot_names(self.__class__))
+
+    def __to_jsonable__(self):
+        return to_jsonable(self)
+
     @staticmethod
     def __from_jsonable__(value):
-        class_name = value["__adaptive_class_name__"]
-        class_ = AdaptiveValueType.__known_subclasses__[class_name]
-        args = [value[slot_name] for slot_name in class_.__slots__]
-        return class_(*args)
+        return from_jsonable(value)
+
+
+def slot_names(cls):
+    slots = cls.__slots__
+    if isinstance(slots, basestring):
+        return (slots,)
+    return tuple(slots)
+
+
+def compile_codecs(cls):
+    """
+    Build codecs specialised to cls's slots, so that the per-value work is
+    one dict display, one tuple, or one object with its slots filled.
+    encode and decode convert to and from the tagged dict; values and build
+    convert to and from a tuple in slot order. Like unpickling, decode and
+    build fill the slots without calling __init__.
+    """
+    slots = slot_names(cls)
+    fields = ["%r: self.%s" % (slot_name, slot_name) for slot_name in slots]
+    attributes = ["self.%s" % slot_name for slot_name in slots]
+    from_dict = ["    self.%s = value[%r]\n" % (slot_name, slot_name) for slot_name in slots]
+    from_tuple = ["    self.%s = values[%d]\n" % (slot_name, idx) for idx, slot_name in enumerate(slots)]
+    source = ("def encode(self):\n"
+              "    return {%s}\n"
+              "def decode(value):\n"
+              "    self = new(cls)\n"
+              "%s"
+              "    return self\n"
+              "def values(self):\n"
+              "    return (%s)\n"
+              "def build(values):\n"
+              "    self = new(cls)\n"
+              "%s"
+              "    return self\n") % (", ".join(["CLASS_KEY: name"] + fields), "".join(from_dict),
+                                      "".join(attr + ", " for attr in attributes), "".join(from_tuple))
+    namespace = {"cls": cls, "new": cls.__new__, "name": cls.__name__, "CLASS_KEY": CLASS_KEY}
+    exec compile(source, "<adaptive codecs for %s>" % cls.__name__, "exec") in namespace
+    return namespace["encode"], namespace["decode"], namespace["values"], namespace["build"]
+
+
+def shared_values(obj):
+    """ids of the AdaptiveValues reachable from obj more than once"""
+    seen = set()
+    shared = set()
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, AdaptiveValueType):
+            key = id(value)
+            if key in seen:
+                shared.add(key)
+                continue
+            seen.add(key)
+            stack.extend(value.__adaptive_values__())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif isinstance(value, dict):
+            stack.extend(value.itervalues())
+    return shared
+
+
+def to_jsonable(obj):
+    """
+    Deep encoding of obj in which an AdaptiveValue reached more than once
+    is written out in full the first time, tagged with an ID_KEY, and as
+    a REF_KEY back-reference after that. This keeps shared values shared
+    and makes cycles encodable.
+    """
+    shared = shared_values(obj)
+    ids = {}  # id() of a shared value already written -> its ID_KEY
+
+    def encode(value):
+        if isinstance(value, AdaptiveValueType):
+            key = id(value)
+            if key in ids:
+                return {REF_KEY: ids[key]}
+            res = value.__adaptive_encode__()
+            if key in shared:
+                ids[key] = res[ID_KEY] = len(ids)
+            for name, item in res.items():
+                res[name] = encode(item)
+            return res
+        if isinstance(value, (list, tuple)):
+            return [encode(item) for item in value]
+        if isinstance(value, dict):
+            return dict((name, encode(item)) for name, item in value.iteritems())
+        return value
+
+    return encode(obj)
+
+
+def from_jsonable(obj):
+    """
+    Rebuild the values in obj, a decoded JSON document, including the
+    references written by to_jsonable. A value's slots are filled after it
+    is registered under its ID_KEY, so references back to it from within
+    resolve; references met before the value itself are filled in at the
+    end.
+    """
+    values = {}  # ID_KEY -> rebuilt value
+    fixups = []  # (assign, ID_KEY) for references met before their value
+
+    def decode(value, assign):
+        if isinstance(value, dict):
+            if REF_KEY in value:
+                ref = value[REF_KEY]
+                if ref in values:
+                    return values[ref]
+                fixups.append((assign, ref))
+                return None
+            cls = AdaptiveValueType.__known_subclasses__.get(value.get(CLASS_KEY))
+            if cls is not None and all(slot_name in value for slot_name in slot_names(cls)):
+                res = cls.__new__(cls)
+                if ID_KEY in value:
+                    values[value[ID_KEY]] = res
+                for slot_name in slot_names(cls):
+                    setattr(res, slot_name, decode(value[slot_name], functools.partial(setattr, res, slot_name)))
+                return res
+            res = {}
+            if ID_KEY in value:
+                values[value[ID_KEY]] = res
+            for name, item in value.iteritems():
+                res[name] = decode(item, functools.partial(res.__setitem__, name))
+            return res
+        if isinstance(value, list):
+            res = [None] * len(value)
+            for idx, item in enumerate(value):
+                res[idx] = decode(item, functools.partial(res.__setitem__, idx))
+            return res
+        return value
+
+    res = decode(obj, None)
+    for assign, ref in fixups:
+        assign(values[ref])
+    return res
 
 
 def AdaptiveValue(cls):
+    encode, decode, values, build = compile_codecs(cls)
+    cls.__adaptive_encode__ = encode
+    cls.__adaptive_values__ = values
     AdaptiveValueType.__known_subclasses__[cls.__name__] = cls
+    AdaptiveValueType.__known_decoders__[cls.__name__] = decode
+    AdaptiveValueType.__known_builders__[cls.__name__] = build
     return cls
 
 
 class AdaptiveJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, AdaptiveValueType):
-            return obj.__to_jsonable__()
+            return obj.__adaptive_encode__()
+        if isinstance(obj, collections.Sequence):  # e.g. a lazy.LazyList
+            return list(obj)
         return json.JSONEncoder.default(self, obj)
 
 
-def adaptive_object_hook(obj_dict):
+def adaptive_object_hook(obj_dict, decoders=AdaptiveValueType.__known_decoders__):
+    # Called for every JSON object, so plain dicts get through on two lookups.
+    decode = decoders.get(obj_dict.get(CLASS_KEY))
+    if decode is None:
+        return obj_dict
     try:
-        return AdaptiveValueType.__from_jsonable__(obj_dict)
-    except KeyError:
+        return decode(obj_dict)
+    except KeyError:  # Missing a slot; leave it as a plain dict
         return obj_dict
 
 
-def serialize(obj):
-    return json.dumps(obj, cls=AdaptiveJSONEncoder, separators=(',', ':'))
+_encoder = AdaptiveJSONEncoder(separators=(',', ':'))
+_decoder = json.JSONDecoder(object_hook=adaptive_object_hook)
+_plain_decoder = json.JSONDecoder()
+_ref_marker = '"%s"' % REF_KEY
+
+
+def serialize(obj, share=False):
+    """With share, encode shared values and cycles by reference; see to_jsonable"""
+    if share:
+        return _encoder.encode(to_jsonable(obj))
+    return _encoder.encode(obj)
 
 
 def deserialize(data):
-    return json.loads(data, object_hook=adaptive_object_hook)
+    # The object hook builds values bottom up, which cannot tie a value to
+    # references within it, so data with references takes the slow path.
+    if _ref_marker in data:
+        return from_jsonable(_plain_decoder.decode(data))
+    return _decoder.decode(data)
 
 
 @AdaptiveValue
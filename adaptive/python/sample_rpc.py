@@ -14,10 +14,11 @@
 
 # Python-to-Python RPC using pickle and HTTP
 
-import os, urllib2, exceptions
+import os, sys, time, zlib, select, collections, signal, socket, httplib, urllib2, urlparse, exceptions, threading, Queue
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 from runtime import serialize, deserialize, AdaptiveException
+import binary, lazy, metrics, tracing, balance, deadlines, hedging
 
 
 def call_to_url_path(name, args):
@@ -29,39 +30,863 @@ def url_path_to_call(path):
     return name, args
 
 
+CONTENT_TYPE = "application/json"
+
+
+class Codec(object):
+    def __init__(self, content_type, serialize, deserialize):
+        self.content_type = content_type
+        self.serialize = serialize
+        self.deserialize = deserialize
+
+
+JSON = Codec(CONTENT_TYPE, serialize, deserialize)
+BINARY = Codec(binary.CONTENT_TYPE, binary.serialize, binary.deserialize)
+CODECS = dict((codec.content_type, codec) for codec in (JSON, BINARY))
+# JSON that sends values reached more than once by reference, so shared
+# values stay shared and cycles can be sent. Any JSON peer decodes it.
+SHARED_JSON = Codec(CONTENT_TYPE, lambda obj: serialize(obj, share=True), deserialize)
+
+
+def negotiate(accept):
+    """Pick the codec for a response: the first supported type in accept, else JSON"""
+    for media_range in (accept or "").split(","):
+        codec = CODECS.get(media_range.split(";")[0].strip())
+        if codec:
+            return codec
+    return JSON
+
+
+ENCODINGS = ("gzip", "deflate")  # content codings supported, in order of preference
+
+
+def negotiate_encoding(accept_encoding):
+    """Pick the content coding for a response from Accept-Encoding, or None"""
+    weights = {}
+    for item in (accept_encoding or "").split(","):
+        params = item.split(";")
+        coding = params[0].strip().lower()
+        weight = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding] = weight
+    default = weights.get("*", 0.0)
+    best = max(ENCODINGS, key=lambda coding: weights.get(coding, default))
+    if weights.get(best, default) > 0:
+        return best
+    return None
+
+
+def compress(data, coding, level):
+    if coding == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return zlib.compress(data, level)
+
+
+def decompress(data, coding):
+    if not coding or coding == "identity":
+        return data
+    if coding == "gzip":
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if coding == "deflate":
+        try:
+            return zlib.decompress(data)
+        except zlib.error:  # Raw deflate without the zlib header, as some servers send
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    raise httplib.HTTPException("Unsupported Content-Encoding %r" % coding)
+
+
+def call_to_body(name, args, codec=JSON):
+    return codec.serialize((name, args))
+
+
+def body_to_call(body, codec=JSON):
+    name, args = codec.deserialize(body)
+    return name, args
+
+
+BATCH_PATH = "batch"
+STREAM_PATH = "stream"
+
+
+def body_to_batch(body, codec=JSON):
+    return [(name, args) for name, args in codec.deserialize(body)]
+
+
 def pack_exception(exc):
     return AdaptiveException(exc.__class__.__name__, str(exc))
 
 
+def run_method(method, args):
+    if deadlines.expired():
+        return False, pack_exception(deadlines.DeadlineExceeded("the caller gave up before %s ran" % method.__name__))
+    try:
+        return True, method(*args)
+    except Exception as exc:
+        return False, pack_exception(exc)
+
+
+def output_error(output):
+    """Exception class name of a failed run_method output, or None"""
+    okay, res = output
+    return None if okay else getattr(res, "name", res.__class__.__name__)
+
+
+def run_batch(instance, calls, observe=None):
+    """With observe, calls observe(command, seconds, output) after each method"""
+    outputs = []
+    for command, args in calls:
+        try:
+            method = getattr(instance, command)
+        except AttributeError as exc:
+            outputs.append((False, pack_exception(exc)))
+        else:
+            start = time.time()
+            output = run_method(method, args)
+            if observe is not None:
+                observe(command, time.time() - start, output)
+            outputs.append(output)
+    return outputs
+
+
+ERRORS = {"DeadlineExceeded": deadlines.DeadlineExceeded}  # raised as themselves on the client
+
+
+def unpack_output(okay, res):
+    if okay:
+        return res
+    try:
+        exc = ERRORS.get(res.name) or getattr(exceptions, res.name)
+        raise exc(res.value)
+    except AttributeError:  # One of res.name, res.value, or the getattr
+        raise res
+
+
 # Client side
 
+class SerializedSizer(object):
+    """CacheSizer for generated clients: charges each result its wire size"""
+
+    def size(self, result):
+        return len(serialize(result))
+
+
+class Future(object):
+    """
+    The eventual result of a call that has been queued for a batch or a
+    pipeline. result() waits no longer than the deadline current when the
+    future was made.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+        self.deadline = deadlines.current()
+
+    def set_result(self, value):
+        self.value = value
+        self.done.set()
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.done.set()
+
+    def result(self, timeout=None):
+        if timeout is None:
+            deadlines.wait(self.done, self.deadline)
+        elif not self.done.wait(timeout):
+            raise RuntimeError("timed out waiting for a batched call")
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class Batch(object):
+    """
+    Queues calls and sends them to the server in a single request:
+
+        with client.batch() as batch:
+            pets = [batch.call("addPet", [name, None]) for name in names]
+        print [pet.result() for pet in pets]
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []  # (name, args, future)
+
+    def call(self, name, args):
+        future = Future()
+        self.calls.append((name, args, future))
+        return future
+
+    def flush(self):
+        calls, self.calls = self.calls, []
+        self.client.send_batch(calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+class AutoBatcher(object):
+    """Combines calls made within window seconds of each other into one batch"""
+
+    def __init__(self, client, window, max_size=64):
+        self.client = client
+        self.window = window
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.calls = []
+        self.timer = None
+
+    def submit(self, name, args):
+        future = Future()
+        calls = None
+        with self.lock:
+            self.calls.append((name, args, future))
+            if len(self.calls) >= self.max_size:
+                calls = self.take()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if calls:
+            self.client.send_batch(calls)
+        return future
+
+    def take(self):
+        calls, self.calls = self.calls, []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return calls
+
+    def flush(self):
+        with self.lock:
+            calls = self.take()
+        if calls:
+            self.client.send_batch(calls)
+
+
+class SingleFlight(object):
+    """Collapses concurrent calls with the same key into one call"""
+
+    class Flight(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.exc_info = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> Flight
+
+    def do(self, key, func, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = SingleFlight.Flight()
+
+        if not leader:
+            # Followers give up at their own deadline, not the leader's.
+            deadlines.wait(flight.done, deadlines.current())
+            if flight.exc_info:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return flight.result
+
+        try:
+            flight.result = func(*args)
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP connections to one host.
+
+    At most size idle connections are kept; connections idle for longer
+    than idle_timeout seconds are closed instead of being reused. Keep it
+    below the server's keep-alive timeout, so that the client gives up on
+    a connection before the server closes it. Connections the server has
+    closed anyway are dropped when they are next acquired.
+    """
+
+    def __init__(self, scheme, netloc, size=8, idle_timeout=4.0, timeout=None):
+        if scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = netloc
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []  # (connection, time it was released)
+
+    def connect(self):
+        return self.connection_class(self.netloc, timeout=self.timeout)
+
+    def acquire(self):
+        """Return (connection, reused)"""
+        stale = []
+        try:
+            with self.lock:
+                while self.idle:
+                    conn, released = self.idle.pop()
+                    if time.time() - released <= self.idle_timeout and self.alive(conn):
+                        return conn, True
+                    stale.append(conn)
+        finally:
+            for conn in stale:
+                conn.close()
+        return self.connect(), False
+
+    def alive(self, conn):
+        """False if the server closed idle conn, or sent on it unasked"""
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+_pools = {}  # (scheme, netloc) -> ConnectionPool
+_pools_lock = threading.Lock()
+
+
+def pool_for(url, **kwargs):
+    """Return the shared connection pool for url's host, creating it with kwargs"""
+    parts = urlparse.urlsplit(url)
+    key = parts.scheme, parts.netloc
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(parts.scheme, parts.netloc, **kwargs)
+        return _pools[key]
+
+
 class RPCClient(object):
-    def __init__(self, url):
-        self.url = url
+    """
+    Calls go out as POSTs with the encoded call as the body. Idempotent
+    fetches use the cacheable GET form instead when the encoded call fits
+    in max_get_path bytes of URL.
+
+    With batch_window set, calls made from different threads within that
+    many seconds of each other share a single batch request.
+
+    Request bodies use codec, and responses are asked for in codec but
+    decoded according to whatever Content-Type the server sends back.
+    SHARED_JSON sends shared and cyclic values in arguments by reference.
+
+    With lazy set, JSON responses are decoded as they are read; see lazy.py.
+    With compression set, servers may send responses gzip or deflate encoded.
+    With tracer set, the phases of each call are reported to it; see tracing.py.
+
+    call_async sends calls pipelined over connections of their own; see
+    pipeline.py.
+
+    With deadline set, calls give up after that many seconds, or after
+    method_deadlines[name] for the methods listed there; see deadlines.py.
+    With hedge set, fetches are hedged: True hedges all of them, or it can
+    be the names of the methods to hedge; see hedging.py.
+
+    url may also be a list of URLs of the same service, in which case each
+    request goes to one of them as picked by policy; see balance.py.
+    """
+
+    def __init__(self, url, pool_size=8, idle_timeout=4.0, timeout=None, max_get_path=1024,
+                 batch_window=None, max_batch=64, codec=JSON, lazy=False, compression=True,
+                 tracer=None, policy=balance.EWMA, deadline=None, method_deadlines=None, hedge=False):
+        urls = [url] if isinstance(url, basestring) else list(url)
+        if not urls:
+            raise ValueError("no URLs to call")
+        self.url = urls[0]
+        self.codec = codec
+        self.tracer = tracer
+        self.lazy = lazy
+        self.compression = compression
+        self.accept = codec.content_type
+        if codec.content_type != CONTENT_TYPE:
+            self.accept += ", " + CONTENT_TYPE  # servers without codec answer in JSON
+        endpoints = [balance.Endpoint(u, pool_for(u, size=pool_size, idle_timeout=idle_timeout, timeout=timeout))
+                     for u in urls]
+        self.balancer = balance.Balancer(endpoints, policy)
+        self.deadline = deadline
+        self.method_deadlines = method_deadlines or {}
+        self.hedger = hedging.Hedger() if hedge else None
+        self.hedged = None if hedge is True else frozenset(hedge or ())  # None for all
+        self.max_get_path = max_get_path
+        self.flights = SingleFlight()
+        self.pipelines = {}  # endpoint URL -> PipelinedClient
+        self.pipeline_lock = threading.Lock()
+        self.state_lock = threading.RLock()  # for generated clients; see lock()
+        self.batcher = None
+        if batch_window is not None:
+            self.batcher = AutoBatcher(self, batch_window, max_batch)
 
     def call(self, name, args):
-        url = self.url + call_to_url_path(name, args)
-        u = urllib2.urlopen(url)
-        okay, res = deserialize(u.read())
-        if okay:
-            return res
+        with self.within(name):
+            if self.batcher:
+                return self.batcher.submit(name, args).result()
+            body = self.traced(name, "serialize", call_to_body, name, args, self.codec)
+            return self.request("POST", "", body, name)
+
+    def fetch(self, name, args):
+        with self.within(name):
+            if self.batcher:
+                return self.flights.do(call_to_body(name, args), self.call, name, args)
+            path = self.traced(name, "serialize", call_to_url_path, name, args)
+            if len(path) <= self.max_get_path:
+                request = "GET", path, None
+            else:
+                request = "POST", "", self.traced(name, "serialize", call_to_body, name, args, self.codec)
+            if self.hedger is not None and (self.hedged is None or name in self.hedged):
+                return self.flights.do(request, self.hedger.call, name, self.request, *(request + (name,)))
+            return self.flights.do(request, self.request, *(request + (name,)))
+
+    def within(self, name):
+        """Context with the deadline of a call of name"""
+        return deadlines.within(self.method_deadlines.get(name, self.deadline))
+
+    def traced(self, name, phase, func, *args):
+        if self.tracer is None:
+            return func(*args)
+        self.tracer.begin(name, phase)
         try:
-            exc = getattr(exceptions, res.name)
-            raise exc(res.value)
-        except AttributeError:  # One of res.name, res.value, or the getattr
-            raise res
+            return func(*args)
+        finally:
+            self.tracer.end(name, phase)
+
+    def call_async(self, name, args, idempotent):
+        """Future of the result, for clients generated with --async"""
+        url = self.balancer.pick().url
+        if url not in self.pipelines:
+            import pipeline  # which imports this module
+            with self.pipeline_lock:
+                if url not in self.pipelines:
+                    self.pipelines[url] = pipeline.PipelinedClient(url, codec=self.codec,
+                                                                   compression=self.compression)
+        with self.within(name):
+            return self.pipelines[url].call_async(name, args, idempotent)
+
+    def close(self):
+        """Close the idle pooled connections and the pipelined clients"""
+        for endpoint in self.balancer.endpoints:
+            endpoint.pool.clear()
+        with self.pipeline_lock:
+            pipelines, self.pipelines = self.pipelines.values(), {}
+        for client in pipelines:
+            client.close()
+
+    def batch(self):
+        return Batch(self)
+
+    def send_batch(self, calls):
+        """Send [(name, args, future)] as one request and resolve the futures"""
+        # The batch is worth sending while any of its callers still waits.
+        ends = [future.deadline for _, _, future in calls]
+        outer = deadlines.current()
+        deadlines.set_deadline(None if None in ends else max(ends))
+        try:
+            body = self.codec.serialize([(name, args) for name, args, _ in calls])
+            outputs = self.roundtrip("POST", "/" + BATCH_PATH, body, BATCH_PATH)
+            if len(outputs) != len(calls):
+                raise ValueError("batch of %d calls got %d results" % (len(calls), len(outputs)))
+        except Exception:
+            exc_info = sys.exc_info()
+            for _, _, future in calls:
+                future.set_exception(exc_info)
+            return
+        finally:
+            deadlines.set_deadline(outer)
+        for (_, _, future), (okay, res) in zip(calls, outputs):
+            try:
+                future.set_result(unpack_output(okay, res))
+            except Exception:
+                future.set_exception(sys.exc_info())
+
+    def lock(self):
+        """Called by generated clients around their caches and indexes"""
+        self.state_lock.acquire()
+
+    def unlock(self):
+        self.state_lock.release()
+
+    def prefetch(self, name, args, entry):
+        def refresh():
+            try:
+                result = self.fetch(name, args)
+            except Exception:
+                with self.state_lock:
+                    entry.refresh_failed()
+            else:
+                with self.state_lock:
+                    entry.refreshed(result)
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def stream(self, name, args):
+        """Call a list-returning method and iterate over the elements as they arrive"""
+        body = call_to_body(name, args, self.codec)
+        with self.within(name):
+            conn, response = self.open("POST", "/" + STREAM_PATH, body)
+        return ResultStream(self, conn, response)
+
+    def send(self, conn, method, path, body):
+        """Send a request for path, which includes the endpoint's base path"""
+        headers = {"Accept": self.accept}
+        trace_id = self.tracer.trace_id() if self.tracer is not None else tracing.current_trace_id()
+        if trace_id:
+            headers[tracing.TRACE_HEADER] = trace_id
+        deadline = deadlines.to_header()
+        if deadline:
+            headers[deadlines.DEADLINE_HEADER] = deadline
+            # Each blocking socket operation may take up to what is left;
+            # finish puts the usual timeout back.
+            conn.timeout = deadlines.remaining()
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+        if self.compression:
+            headers["Accept-Encoding"] = "gzip, deflate"
+        if body is not None:
+            headers["Content-Type"] = self.codec.content_type
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    def open(self, method, path, body=None):
+        """
+        Send a request on a pooled connection to the endpoint the balancer
+        picks; return (conn, response) with the body unread. The request
+        counts as outstanding until finish or discard is called on conn.
+        """
+        endpoint = self.balancer.pick()
+        started = self.balancer.begin(endpoint)
+        try:
+            conn, response = self.send_to(endpoint, method, endpoint.base_path + path, body)
+        except Exception:
+            self.balancer.end(endpoint, started, True)
+            raise
+        conn.endpoint, conn.started = endpoint, started
+        return conn, response
+
+    def send_to(self, endpoint, method, path, body):
+        conn, reused = endpoint.pool.acquire()
+        try:
+            return conn, self.send(conn, method, path, body)
+        except socket.timeout:  # The server is slow, not gone
+            conn.close()
+            raise
+        except (httplib.HTTPException, socket.error) as exc:
+            conn.close()
+            # The server may have closed an idle keep-alive connection just
+            # as it was reused, so retry a GET once on a fresh connection.
+            # A POST is not sent twice: from here there is no telling
+            # whether it ran before the connection went.
+            if not reused or method != "GET":
+                raise
+            conn = endpoint.pool.connect()
+            try:
+                return conn, self.send(conn, method, path, body)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+    def settle(self, conn, failed):
+        """Report the end of the request on conn to the balancer, once"""
+        endpoint = conn.endpoint
+        if endpoint is not None:
+            conn.endpoint = None
+            self.balancer.end(endpoint, conn.started, failed)
+        return endpoint
+
+    def finish(self, conn, response):
+        """Return conn to the pool once response has been read completely"""
+        endpoint = self.settle(conn, response.status >= 500)
+        if response.will_close or endpoint is None:
+            conn.close()
+        else:
+            if conn.timeout != endpoint.pool.timeout:
+                conn.timeout = endpoint.pool.timeout
+                conn.sock.settimeout(conn.timeout)
+            endpoint.pool.release(conn)
+
+    def discard(self, conn, failed=True):
+        """Close conn, whose response will not be read completely"""
+        self.settle(conn, failed)
+        conn.close()
+
+    def check(self, response, url):
+        """url is that of the endpoint that answered"""
+        if response.status != 200:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+
+    def response_codec(self, response):
+        content_type = response.getheader("Content-Type", CONTENT_TYPE).split(";")[0].strip()
+        return CODECS.get(content_type, JSON)
+
+    def receive(self, method, path, body):
+        try:
+            conn, response = self.open(method, path, body)
+            url = conn.endpoint.url  # settled by finish
+            try:
+                data = response.read()
+            except Exception:
+                self.discard(conn)
+                raise
+        except socket.timeout:
+            if deadlines.current() is not None:
+                raise deadlines.DeadlineExceeded("no response before the deadline")
+            raise
+        self.finish(conn, response)
+        self.check(response, url)
+        return response, data
+
+    def decode(self, response, data):
+        data = decompress(data, response.getheader("Content-Encoding"))
+        codec = self.response_codec(response)
+        if self.lazy and codec is JSON:
+            return lazy.deserialize(data)
+        return codec.deserialize(data)
+
+    def roundtrip(self, method, path, body=None, name=None):
+        """name is the method called, for the tracer"""
+        response, data = self.traced(name, "wait", self.receive, method, path, body)
+        return self.traced(name, "deserialize", self.decode, response, data)
+
+    def request(self, method, path, body=None, name=None):
+        # Indexed rather than unpacked, which would make a lazy output find
+        # the end of the result.
+        output = self.roundtrip(method, path, body, name)
+        return unpack_output(output[0], output[1])
+
+
+class ResultStream(object):
+    """
+    Iterator over a streamed list result. The server sends the elements in
+    frames of a few at a time, and only one frame is decoded at a time.
+    read() is the RPCStream interface of generated clients: it returns the
+    next element, or None at the end.
+    """
+
+    def __init__(self, client, conn, response):
+        self.client = client
+        self.conn = conn
+        self.response = response
+        if response.status != 200:
+            url = conn.endpoint.url
+            self.close(response.status >= 500)
+            client.check(response, url)
+        self.codec = client.response_codec(response)
+        self.items = collections.deque()
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self.items:
+            if self.done:
+                raise StopIteration
+            self.items.extend(self.frame())
+        return self.items.popleft()
+
+    def read(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return None
+
+    def frame(self):
+        # Frames are "<length>\n<payload>". HTTPResponse.read(n) blocks until
+        # it has n bytes, so read exactly as much as each frame needs.
+        try:
+            header = ""
+            while not header.endswith("\n"):
+                byte = self.response.read(1)
+                if not byte:
+                    if header:
+                        raise httplib.IncompleteRead(header)
+                    self.done = True
+                    self.client.finish(self.conn, self.response)
+                    self.conn = None
+                    return ()
+                header += byte
+            length = int(header)
+            payload = self.response.read(length)
+            if len(payload) != length:
+                raise httplib.IncompleteRead(payload, length - len(payload))
+        except Exception:
+            self.close(True)
+            raise
+        okay, items = self.codec.deserialize(payload)
+        if not okay:
+            # An error frame is always the last one.
+            self.drain()
+        return unpack_output(okay, items)
+
+    def drain(self):
+        self.done = True
+        try:
+            self.response.read()
+        except Exception:
+            self.close(True)
+        else:
+            self.client.finish(self.conn, self.response)
+            self.conn = None
+
+    def close(self, failed=False):
+        """Abandon the rest of the stream"""
+        self.done = True
+        if self.conn is not None:
+            self.client.discard(self.conn, failed)
+            self.conn = None
 
 
 # Server side
 
 class ServiceRequestHandler(BaseHTTPRequestHandler):
 
+    protocol_version = "HTTP/1.1"  # keep connections alive between calls
+    timeout = 60  # seconds before an idle keep-alive connection is dropped
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+    stream_chunk_size = 100  # list elements per frame of a streamed result
+    share_references = False  # send JSON responses with SHARED_JSON
+    compression_min_size = 1024  # smaller responses are sent uncompressed
+    compression_level = 6  # zlib level from 1 to 9, or 0 not to compress
+    compression_levels = {}  # method name -> level, overriding compression_level
+    registry = metrics.REGISTRY  # per-method metrics, or None not to collect them
+    metrics_path = "/metrics"  # where registry is served, or None not to serve it
+    metrics_local_only = True  # serve it to loopback clients only
+    result_cache = None  # resultcache.ResultCache for query results, or None not to cache them
     services = {}  # name -> instance
 
+    def setup(self):
+        self.timeout = getattr(self.server, "keepalive_timeout", self.timeout)
+        BaseHTTPRequestHandler.setup(self)
+
+    def handle(self):
+        # As BaseHTTPRequestHandler.handle, but give up an idle keep-alive
+        # connection when other connections are waiting for a worker.
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def server_busy(self):
+        busy = getattr(self.server, "busy", None)
+        return busy is not None and busy()
+
+    def buffered(self):
+        buf = getattr(self.rfile, "_rbuf", None)
+        if buf is None:
+            return False
+        buf.seek(0, 2)
+        return buf.tell() > 0
+
+    def wait_for_request(self):
+        deadline = time.time() + self.timeout
+        while True:
+            if self.buffered():
+                return True
+            ready, _, _ = select.select([self.connection], [], [], 0)
+            if ready:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0 or self.server_busy():
+                return False
+            select.select([self.connection], [], [], min(remaining, 0.5))
+
     def do_GET(self):
+        if self.metrics_path is not None and self.path == self.metrics_path:
+            self.send_metrics()
+            return
+        self.handle_call(lambda call_path: (None, [url_path_to_call(call_path)]), len(self.path))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        content_type = self.headers.gettype()
+        codec = CODECS.get(content_type)
+        if codec is None:
+            self.reject(415, "Unsupported Media Type: %s" % content_type)
+            return
+
+        def decode(call_path):
+            if call_path == BATCH_PATH:
+                return BATCH_PATH, body_to_batch(body, codec)
+            if call_path == STREAM_PATH:
+                return STREAM_PATH, [body_to_call(body, codec)]
+            return None, [body_to_call(body, codec)]
+        self.handle_call(decode, len(body))
+
+    def local_client(self):
+        host = self.client_address[0]
+        return host.startswith(("127.", "::ffff:127.")) or host == "::1"
+
+    def send_metrics(self):
+        if self.registry is None or (self.metrics_local_only and not self.local_client()):
+            self.send_error(404, "Not found")
+            return
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reject(self, res, error):
+        if self.registry is not None:
+            self.registry.reject(res)
+        self.send_error(res, error)
+
+    def handle_call(self, decode, size):
+        """size is that of the request, for the metrics"""
+        start = time.time()
+        trace_id = self.headers.getheader(tracing.TRACE_HEADER)
+        tracing.set_trace_id(trace_id)
+        deadlines.set_deadline(deadlines.from_header(self.headers.getheader(deadlines.DEADLINE_HEADER), start))
         res = 404
         error = "Not found"
         body = None
+        cache_key = None
+        level = self.compression_level
+        codec = negotiate(self.headers.getheader("Accept"))
+        if codec is JSON and self.share_references:
+            codec = SHARED_JSON
 
         components = self.path.split("/")
         while components and not components[0].strip():
@@ -78,49 +903,268 @@ class ServiceRequestHandler(BaseHTTPRequestHandler):
                 break
 
             try:
-                command, args = url_path_to_call(call_path)
+                mode, calls = decode(call_path)
             except Exception:
                 res = 400
                 error = "Bad Request: Failed to parse operation"
                 break
+            decoded = time.time()
 
-            try:
-                method = getattr(instance, command)
-            except AttributeError:
-                error = "Not found: %s :: %r" % (name, command)
-                break
-
-            try:
-                output = True, method(*args)
-            except Exception as exc:
-                output = False, pack_exception(exc)
+            if mode == BATCH_PATH:
+                # Each method is recorded on its own, and the batch as a
+                # whole under BATCH_PATH.
+                command = BATCH_PATH
+                observe = None
+                if self.registry is not None:
+                    observe = lambda command, seconds, output: self.registry.method(name, command).record(
+                        impl=seconds, error=output_error(output))
+                output = run_batch(instance, calls, observe)
+                self.invalidate(name, instance, calls, output)
+            else:
+                command, args = calls[0]
+                try:
+                    method = getattr(instance, command)
+                except AttributeError:
+                    error = "Not found: %s :: %r" % (name, command)
+                    break
+                if mode == STREAM_PATH:
+                    stats = self.registry and self.registry.method(name, command)
+                    okay = self.stream_output(codec, method, args, stats, decoded - start, size)
+                    self.invalidate(name, instance, calls, [(okay, None)])
+                    return
+                level = self.compression_levels.get(command, level)
+                if self.result_cache is not None and command in getattr(instance, "queries", ()):
+                    accepted = negotiate_encoding(self.headers.getheader("Accept-Encoding")) if level else None
+                    cache_key = name, command, codec.content_type, accepted, JSON.serialize(args)
+                    cached = self.result_cache.get(cache_key)
+                    if cached is not None:
+                        body, coding = cached
+                        if self.registry is not None:
+                            self.registry.method(name, command).record(
+                                decode=decoded - start, request_bytes=size, response_bytes=len(body))
+                        self.send_body(codec, body, coding, trace_id)
+                        return
+                    generation = self.result_cache.generation(name)
+                output = run_method(method, args)
+                self.invalidate(name, instance, calls, [output])
+            ran = time.time()
 
             res = 200
             try:
-                body = serialize(output)
+                body = codec.serialize(output)
                 error = None
             except Exception as exc:
                 print "Returning", output
                 print "Failed because:", exc
-                raise
+                if self.registry is not None:
+                    self.registry.method(name, command).record(
+                        decode=decoded - start, impl=ran - decoded, request_bytes=size,
+                        error=exc.__class__.__name__)
+                # Answer rather than drop the connection, which the client
+                # could not tell from a keep-alive connection timing out.
+                # send_error adds Connection: close.
+                self.send_error(500, "Internal Server Error: failed to encode the result")
+                return
 
             break
 
         if error:
-            self.send_error(res, error)
+            self.reject(res, error)
+            return
+
+        coding = None
+        if level and len(body) >= self.compression_min_size:
+            coding = negotiate_encoding(self.headers.getheader("Accept-Encoding"))
+            if coding:
+                body = compress(body, coding, level)
+        if self.registry is not None:
+            self.registry.method(name, command).record(
+                decode=decoded - start, impl=ran - decoded, encode=time.time() - ran,
+                request_bytes=size, response_bytes=len(body),
+                error=None if mode == BATCH_PATH else output_error(output))
+        if cache_key is not None and output[0]:
+            self.result_cache.put(cache_key, (body, coding), generation)
+        self.send_body(codec, body, coding, trace_id)
+
+    def invalidate(self, name, instance, calls, outputs):
+        """Drop the cached query results that the calls that succeeded may have changed"""
+        if self.result_cache is None:
             return
+        queries = getattr(instance, "queries", ())
+        invalidates = getattr(instance, "invalidates", {})
+        for (command, _), (okay, _) in zip(calls, outputs):
+            if okay and command not in queries:
+                self.result_cache.invalidate(name, invalidates.get(command))
+
+    def send_body(self, codec, body, coding, trace_id):
+        self.send_response(200)
+        self.send_header("Content-Type", codec.content_type)
+        self.send_header("Vary", "Accept, Accept-Encoding")
+        if coding:
+            self.send_header("Content-Encoding", coding)
+        if trace_id:
+            self.send_header(tracing.TRACE_HEADER, trace_id)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-        self.send_response(res)
+    def stream_output(self, codec, method, args, stats=None, decode=None, request_bytes=None):
+        """
+        Send a list result in frames of stream_chunk_size elements over a
+        chunked response. A method that returns a generator is never held
+        in memory as a whole.
+
+        With stats, the call is recorded there. The time a generator
+        spends producing elements counts as encoding.
+
+        Returns False if the method failed. A stream the client abandoned
+        counts as a success, since the method may have changed state.
+        """
+        start = time.time()
+        okay, result = run_method(method, args)
+        if okay and not isinstance(result, (list, tuple)) and not hasattr(result, "next"):
+            okay, result = False, pack_exception(TypeError("%s did not return a list" % method.__name__))
+        ran = time.time()
+
+        self.send_response(200)
+        self.send_header("Content-Type", codec.content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        trace_id = tracing.current_trace_id()
+        if trace_id:
+            self.send_header(tracing.TRACE_HEADER, trace_id)
         self.end_headers()
-        if body:
-            self.wfile.write(body)
+        size, error = None, None
+        try:
+            size, error = self.write_stream(codec, okay, result)
+        except socket.error:
+            # The client abandoned the stream.
+            self.close_connection = 1
+        if stats is not None:
+            stats.record(decode=decode, impl=ran - start, encode=time.time() - ran,
+                         request_bytes=request_bytes, response_bytes=size, error=error)
+        return error is None
+
+    def write_stream(self, codec, okay, result):
+        """Return the size of the body and the exception class name if the result failed"""
+        size = 0
+        if okay:
+            items = iter(result)
+            chunk = []
+            while True:
+                try:
+                    chunk.append(next(items))
+                except StopIteration:
+                    break
+                except Exception as exc:  # The generator failed partway through
+                    okay, result = False, pack_exception(exc)
+                    break
+                if len(chunk) >= self.stream_chunk_size:
+                    size += self.write_frame(codec, (True, chunk))
+                    chunk = []
+            if chunk:
+                size += self.write_frame(codec, (True, chunk))
+        if not okay:
+            size += self.write_frame(codec, (False, result))
+        self.wfile.write("0\r\n\r\n")
+        return size + 5, output_error((okay, result))
+
+    def write_frame(self, codec, output):
+        data = codec.serialize(output)
+        frame = "%d\n%s" % (len(data), data)
+        chunk = "%x\r\n%s\r\n" % (len(frame), frame)
+        self.wfile.write(chunk)
+        return len(chunk)
+
+
+class HostLock(object):
+    """HostLock for generated code, which cannot make locks of its own"""
+
+    def __init__(self):
+        self.rlock = threading.RLock()
+
+    def lock(self):
+        self.rlock.acquire()
+
+    def unlock(self):
+        self.rlock.release()
 
 
 def add_instance(name, instance):
+    # The worker threads share the index log of a generated server.
+    index = getattr(instance, "index", None)
+    if index is not None and getattr(index, "guard", False) is None:
+        index.guard = HostLock()
     ServiceRequestHandler.services[name] = instance
 
 
-def serve_forever(host="0.0.0.0", port=8080):
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer that hands accepted connections to a fixed pool of worker
+    threads. At most backlog connections wait in the listen queue and
+    queue_size more wait for a free worker; beyond that accepting blocks.
+    """
+
+    keepalive_timeout = 5  # longer than ConnectionPool's idle_timeout
+
+    def __init__(self, address, handler_class, workers=16, backlog=128, queue_size=None):
+        self.request_queue_size = backlog
+        HTTPServer.__init__(self, address, handler_class)
+        self.pending = Queue.Queue(queue_size or workers)
+        self.draining = False
+        self.workers = []
+        for idx in range(workers):
+            worker = threading.Thread(target=self.work, name="rpc-worker-%d" % idx)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def busy(self):
+        return self.draining or not self.pending.empty()
+
+    def drain(self, timeout=None):
+        """
+        Stop accepting connections, finish the queued and in-flight
+        requests, and wait up to timeout seconds for the workers to exit.
+        Call after serve_forever has returned.
+        """
+        self.draining = True
+        self.server_close()
+        for worker in self.workers:
+            self.pending.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None else max(0, deadline - time.time()))
+
+
+def serve_forever(host="0.0.0.0", port=8080, workers=16, backlog=128, drain_timeout=30):
     port = int(os.environ.get("SERVER_PORT", port))
-    server = HTTPServer((host, port), ServiceRequestHandler)
-    server.serve_forever()
+    server = PooledHTTPServer((host, port), ServiceRequestHandler, workers=workers, backlog=backlog)
+
+    def terminate(signum, frame):
+        # shutdown() waits for serve_forever to return, so it can't run here.
+        stopper = threading.Thread(target=server.shutdown)
+        stopper.daemon = True
+        stopper.start()
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.drain(drain_timeout)
@@ -0,0 +1,94 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client-side tracing.
+
+Generated clients and RPCClient report the phases of each call to a
+ClientTracer, as begin(method, phase) and end(method, phase) on the
+calling thread. Generated methods report "marshal" (building args),
+"call" (everything RPCClient does) and "unmarshal" (X_fromMap or
+X_read). RPCClient breaks "call" down into "serialize", "wait" (the
+network and the server) and "deserialize".
+
+A tracer also supplies the trace id that RPCClient sends in the
+X-Trace-Id header. Servers make the id of the request being handled
+available through current_trace_id, so calls made on its behalf carry
+it on.
+"""
+
+import os, threading, time
+
+import metrics
+
+TRACE_HEADER = "X-Trace-Id"
+
+_context = threading.local()
+
+
+def current_trace_id():
+    """Trace id of the request this thread is serving, if any"""
+    return getattr(_context, "trace_id", None)
+
+
+def set_trace_id(trace_id):
+    _context.trace_id = trace_id
+
+
+def new_trace_id():
+    return os.urandom(8).encode("hex")
+
+
+class Recorder(object):
+    """ClientTracer that keeps a latency histogram per method and phase"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # (method, phase) -> metrics.Histogram
+        self.local = threading.local()
+
+    def begin(self, method, phase):
+        starts = self.local.__dict__.setdefault("starts", {})
+        starts[method, phase] = time.time()
+
+    def end(self, method, phase):
+        start = self.local.__dict__.get("starts", {}).pop((method, phase), None)
+        if start is None:
+            return
+        elapsed = time.time() - start
+        with self.lock:
+            histogram = self.histograms.get((method, phase))
+            if histogram is None:
+                histogram = self.histograms[method, phase] = metrics.Histogram(metrics.SECONDS)
+            histogram.observe(elapsed)
+
+    def trace_id(self):
+        return current_trace_id() or new_trace_id()
+
+    def summary(self):
+        """[(method, phase, calls, total seconds)], slowest first"""
+        with self.lock:
+            rows = [(method, phase, sum(histogram.counts), histogram.sum)
+                    for (method, phase), histogram in self.histograms.items()]
+        return sorted(rows, key=lambda row: -row[3])
+
+    def render(self):
+        """The histograms in the Prometheus text exposition format"""
+        name = "adaptive_client_seconds"
+        lines = ["# HELP %s Time per client call spent in each phase." % name,
+                 "# TYPE %s histogram" % name]
+        with self.lock:
+            for (method, phase), histogram in sorted(self.histograms.items()):
+                lines.extend(metrics.histogram_lines(name, histogram, method=method, phase=phase))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,132 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading, time, unittest
+
+from adaptive.python import balance
+from adaptive.python.balance import Balancer, Endpoint
+
+
+class Probe(object):
+    """Probe that fails until healthy is set, counting the probes"""
+
+    def __init__(self):
+        self.healthy = threading.Event()
+        self.probes = 0
+
+    def __call__(self, endpoint):
+        self.probes += 1
+        return self.healthy.is_set()
+
+
+def endpoints(count):
+    return [Endpoint("http://127.0.0.1:%d/Test" % (9000 + idx), None) for idx in range(count)]
+
+
+def succeed(balancer, endpoint, seconds):
+    balancer.begin(endpoint)
+    balancer.end(endpoint, time.time() - seconds, False)
+
+
+def fail(balancer, endpoint, times):
+    for _ in range(times):
+        balancer.end(endpoint, balancer.begin(endpoint), True)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class BalancerTest(unittest.TestCase):
+
+    def test_base_path(self):
+        self.assertEqual(Endpoint("http://host/a/b/", None).base_path, "/a/b")
+        self.assertEqual(Endpoint("http://host", None).base_path, "")
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, Balancer, endpoints(2), "random")
+
+    def test_least_outstanding(self):
+        busy, idle = endpoints(2)
+        balancer = Balancer([busy, idle], balance.LEAST_OUTSTANDING)
+        balancer.begin(busy)
+        self.assertEqual(set(balancer.pick() for _ in range(20)), set([idle]))
+        self.assertEqual((busy.outstanding, idle.outstanding), (1, 0))
+
+    def test_ewma(self):
+        slow, fast = endpoints(2)
+        balancer = Balancer([slow, fast], alpha=0.5)
+        succeed(balancer, slow, 0.4)
+        succeed(balancer, slow, 0.2)
+        self.assertAlmostEqual(slow.latency, 0.3, places=2)
+        succeed(balancer, fast, 0.01)
+        self.assertEqual(set(balancer.pick() for _ in range(20)), set([fast]))
+
+    def test_untried_preferred(self):
+        tried, untried = endpoints(2)
+        balancer = Balancer([tried, untried])
+        succeed(balancer, tried, 0.01)
+        self.assertEqual(set(balancer.pick() for _ in range(20)), set([untried]))
+
+    def test_success_resets_failures(self):
+        endpoint, = endpoints(1)
+        balancer = Balancer([endpoint], max_failures=3, probe=Probe())
+        fail(balancer, endpoint, 2)
+        balancer.end(endpoint, balancer.begin(endpoint), False)
+        fail(balancer, endpoint, 2)
+        self.assertFalse(endpoint.ejected)
+        self.assertEqual(endpoint.failures, 2)
+
+    def test_ejected_and_recovered(self):
+        bad, good = endpoints(2)
+        probe = Probe()
+        balancer = Balancer([bad, good], max_failures=2, eject_time=0.01, max_eject_time=0.02, probe=probe)
+        succeed(balancer, bad, 0.01)
+        fail(balancer, bad, 2)
+        self.assertTrue(bad.ejected)
+        self.assertEqual(set(balancer.pick() for _ in range(20)), set([good]))
+        self.assertTrue(wait_for(lambda: probe.probes >= 3))
+        self.assertTrue(bad.ejected)
+        probe.healthy.set()
+        self.assertTrue(wait_for(lambda: not bad.ejected))
+        self.assertEqual((bad.failures, bad.latency, bad.outstanding), (0, None, 0))
+        self.assertTrue(bad in set(balancer.pick() for _ in range(50)))
+
+    def test_one_prober(self):
+        endpoint, other = endpoints(2)
+        probe = Probe()
+        balancer = Balancer([endpoint, other], max_failures=1, eject_time=0.05, probe=probe)
+        probers = lambda: len([thread for thread in threading.enumerate() if thread.name == "rpc-probe"])
+        before = probers()
+        fail(balancer, endpoint, 5)
+        self.assertEqual(probers(), before + 1)
+        probe.healthy.set()
+        self.assertTrue(wait_for(lambda: not endpoint.ejected))
+
+    def test_all_ejected(self):
+        first, second = endpoints(2)
+        balancer = Balancer([first, second], max_failures=1, eject_time=60, probe=Probe())
+        fail(balancer, first, 1)
+        fail(balancer, second, 1)
+        self.assertTrue(first.ejected and second.ejected)
+        self.assertTrue(balancer.pick() in (first, second))
+
+
+if __name__ == "__main__":
+    unittest.main()
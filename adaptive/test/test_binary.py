@@ -0,0 +1,101 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from adaptive.python import binary, lazy, runtime
+from adaptive.python.runtime import AdaptiveValue, AdaptiveValueType, CLASS_KEY
+
+
+@AdaptiveValue
+class BinaryPet(AdaptiveValueType):
+    __slots__ = "name", "age", "tags", "owner"
+
+    def __init__(self, name, age, tags=(), owner=None):
+        self.name = name
+        self.age = age
+        self.tags = list(tags)
+        self.owner = owner
+
+
+def roundtrip(value):
+    return binary.deserialize(binary.serialize(value))
+
+
+class BinaryTest(unittest.TestCase):
+
+    def test_scalars(self):
+        for value in [None, True, False, 0, 1, -1, 63, -64, 64, 2 ** 31, -2 ** 31 - 1,
+                      2 ** 63 - 1, -2 ** 63, 2 ** 100, 0.0, -1.5, 1e300, "", "abc"]:
+            result = roundtrip(value)
+            self.assertEqual(result, value)
+            self.assertEqual(type(result) is bool, type(value) is bool)
+
+    def test_unicode(self):
+        value = u"caf\xe9 \u2603"
+        self.assertEqual(roundtrip(value), value)
+        self.assertEqual(roundtrip(value.encode("utf-8")), value)
+
+    def test_containers(self):
+        self.assertEqual(roundtrip([]), [])
+        self.assertEqual(roundtrip({}), {})
+        self.assertEqual(roundtrip((1, "two", [3])), [1, "two", [3]])
+        self.assertEqual(roundtrip({"a": 1, "b": [{"c": None}]}), {"a": 1, "b": [{"c": None}]})
+        self.assertEqual(roundtrip({1: "one", "two": 2}), {1: "one", "two": 2})
+
+    def test_records(self):
+        owner = BinaryPet("Alice", 40)
+        pets = [BinaryPet("Fido", 3, ["dog"], owner), BinaryPet("Tom", 5, ["cat", "grey"])]
+        result = roundtrip(pets)
+        self.assertEqual(result, pets)
+        self.assertTrue(all(type(pet) is BinaryPet for pet in result))
+        self.assertEqual(result[0].owner.name, "Alice")
+
+    def test_type_table_shared(self):
+        data = binary.serialize([BinaryPet("Fido", 3), BinaryPet("Tom", 5), {"x": 1}, {"x": 2}])
+        self.assertEqual(data.count("BinaryPet"), 1)
+        self.assertEqual(data.count("owner"), 1)
+        self.assertEqual(data.count("x"), 1)
+
+    def test_lazy_values(self):
+        pets = [BinaryPet("Fido", 3, ["dog"]), BinaryPet("Tom", 5)]
+        self.assertEqual(roundtrip(lazy.deserialize(runtime.serialize(pets))), pets)
+
+    def test_unknown_class(self):
+        data = (chr(binary.VERSION) + "\x01" + chr(binary.CLASS) + "\x07Unknown\x01\x01x" +
+                chr(binary.RECORD) + "\x00" + chr(binary.INT) + "\x02")
+        self.assertEqual(binary.deserialize(data), {CLASS_KEY: "Unknown", "x": 1})
+
+    def test_other_slots(self):
+        # A sender whose BinaryPet has other slots gets a plain dict across.
+        data = (chr(binary.VERSION) + "\x01" + chr(binary.CLASS) + "\x09BinaryPet\x01\x04name" +
+                chr(binary.RECORD) + "\x00" + chr(binary.STR) + "\x04Fido")
+        self.assertEqual(binary.deserialize(data), {CLASS_KEY: "BinaryPet", "name": "Fido"})
+
+    def test_not_serializable(self):
+        self.assertRaises(TypeError, binary.serialize, object())
+
+    def test_malformed(self):
+        data = binary.serialize([BinaryPet("Fido", 3)])
+        for end in range(len(data)):
+            self.assertRaises(binary.BinaryFormatError, binary.deserialize, data[:end])
+        self.assertRaises(binary.BinaryFormatError, binary.deserialize, data + "\0")
+        self.assertRaises(binary.BinaryFormatError, binary.deserialize, chr(binary.VERSION + 1) + data[1:])
+        self.assertRaises(binary.BinaryFormatError, binary.deserialize, chr(binary.VERSION) + "\0\xff")
+        self.assertRaises(binary.BinaryFormatError, binary.deserialize,
+                          chr(binary.VERSION) + "\0" + chr(binary.RECORD) + "\0")
+
+
+if __name__ == "__main__":
+    unittest.main()
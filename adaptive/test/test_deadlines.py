@@ -0,0 +1,93 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket, threading, time, unittest
+
+from adaptive.python import deadlines, sample_rpc
+from adaptive.python.deadlines import DeadlineExceeded
+
+
+class DeadlinesTest(unittest.TestCase):
+
+    def tearDown(self):
+        deadlines.set_deadline(None)
+
+    def test_within(self):
+        self.assertEqual(deadlines.current(), None)
+        with deadlines.within(10):
+            outer = deadlines.current()
+            self.assertTrue(9 < deadlines.remaining() <= 10)
+            with deadlines.within(1):
+                self.assertTrue(deadlines.remaining() <= 1)
+            with deadlines.within(100):
+                self.assertEqual(deadlines.current(), outer)
+            with deadlines.within(None):
+                self.assertEqual(deadlines.current(), outer)
+            self.assertEqual(deadlines.current(), outer)
+        self.assertEqual(deadlines.current(), None)
+
+    def test_per_thread(self):
+        seen = []
+        with deadlines.within(10):
+            thread = threading.Thread(target=lambda: seen.append(deadlines.current()))
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [None])
+
+    def test_header(self):
+        self.assertEqual(deadlines.to_header(), None)
+        with deadlines.within(0.25):
+            self.assertTrue(200 < int(deadlines.to_header()) <= 250)
+        deadlines.set_deadline(time.time() - 1)
+        self.assertTrue(deadlines.expired())
+        self.assertRaises(DeadlineExceeded, deadlines.to_header)
+
+    def test_from_header(self):
+        self.assertEqual(deadlines.from_header("250", 100.0), 100.25)
+        self.assertEqual(deadlines.from_header(None), None)
+        self.assertEqual(deadlines.from_header("soon"), None)
+
+    def test_wait(self):
+        event = threading.Event()
+        self.assertRaises(DeadlineExceeded, deadlines.wait, event, time.time() + 0.05)
+        event.set()
+        deadlines.wait(event, time.time() - 1)
+        deadlines.wait(event, None)
+
+    def test_skipped_when_expired(self):
+        # Servers do not start methods whose caller has given up.
+        ran = []
+        deadlines.set_deadline(time.time() - 1)
+        okay, res = sample_rpc.run_method(ran.append, [1])
+        self.assertEqual((okay, ran), (False, []))
+        self.assertRaises(DeadlineExceeded, sample_rpc.unpack_output, okay, res)
+
+    def test_client_gives_up(self):
+        # A server that accepts connections and never answers
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(8)
+        self.addCleanup(sock.close)
+        url = "http://127.0.0.1:%d/Test" % sock.getsockname()[1]
+        client = sample_rpc.RPCClient(url, deadline=0.2, method_deadlines={"slow": 0.4})
+        self.addCleanup(client.close)
+        for name, seconds in (("find", 0.2), ("slow", 0.4)):
+            start = time.time()
+            self.assertRaises(DeadlineExceeded, client.call, name, [])
+            self.assertTrue(seconds - 0.05 < time.time() - start < seconds + 0.5)
+        self.assertEqual(deadlines.current(), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
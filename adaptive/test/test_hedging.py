@@ -0,0 +1,145 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading, time, unittest
+
+from adaptive.python import deadlines, tracing
+from adaptive.python.hedging import Hedger
+
+
+class Calls(object):
+    """
+    Function whose nth call returns or raises outcomes[n] once released[n]
+    is set, and records the deadline and trace id it ran with
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.released = [threading.Event() for _ in outcomes]
+        self.contexts = []
+        self.lock = threading.Lock()
+
+    def __call__(self, arg):
+        with self.lock:
+            idx = len(self.contexts)
+            self.contexts.append((deadlines.current(), tracing.current_trace_id()))
+        self.released[idx].wait(5)
+        outcome = self.outcomes[idx]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome, arg
+
+    def release(self, *indexes):
+        for idx in indexes:
+            self.released[idx].set()
+
+
+def warmed(seconds=0.05, **kwargs):
+    hedger = Hedger(min_samples=5, **kwargs)
+    for _ in range(5):
+        hedger.record("find", seconds)
+    return hedger
+
+
+class HedgerTest(unittest.TestCase):
+
+    def test_delay(self):
+        hedger = Hedger(percentile=90, min_samples=10)
+        for ms in range(1, 10):
+            hedger.record("find", ms / 1000.0)
+        self.assertEqual(hedger.delay("find"), None)
+        hedger.record("find", 0.01)
+        self.assertEqual(hedger.delay("find"), 0.01)
+        self.assertEqual(hedger.delay("other"), None)
+
+    def test_window(self):
+        hedger = Hedger(window=5, min_samples=5)
+        for seconds in [10, 10, 1, 1, 1, 1, 1]:
+            hedger.record("find", seconds)
+        self.assertEqual(hedger.delay("find"), 1)
+
+    def test_not_hedged_until_sampled(self):
+        calls = Calls("first")
+        calls.release(0)
+        self.assertEqual(Hedger().call("find", calls, "x"), ("first", "x"))
+        self.assertEqual(len(calls.contexts), 1)
+
+    def test_fast_not_hedged(self):
+        calls = Calls("first", "second")
+        calls.release(0, 1)
+        self.assertEqual(warmed(1.0).call("find", calls, "x"), ("first", "x"))
+        self.assertEqual(len(calls.contexts), 1)
+
+    def test_slow_hedged(self):
+        calls = Calls("first", "second")
+        calls.release(1)
+        self.assertEqual(warmed().call("find", calls, "x"), ("second", "x"))
+        self.assertEqual(len(calls.contexts), 2)
+        calls.release(0)
+
+    def test_first_still_wins(self):
+        calls = Calls("first", "second")
+        hedger = warmed()
+        timer = threading.Timer(0.2, calls.release, (0,))
+        timer.start()
+        self.assertEqual(hedger.call("find", calls, "x"), ("first", "x"))
+        self.assertEqual(len(calls.contexts), 2)
+        calls.release(1)
+
+    def test_failure_then_success(self):
+        calls = Calls(ValueError("first"), "second")
+        hedger = warmed()
+        timer = threading.Timer(0.1, calls.release, (0, 1))
+        timer.start()
+        self.assertEqual(hedger.call("find", calls, "x"), ("second", "x"))
+
+    def test_both_fail(self):
+        calls = Calls(ValueError("first"), ValueError("second"))
+        hedger = warmed()
+        threading.Timer(0.1, calls.release, (0,)).start()
+        threading.Timer(0.2, calls.release, (1,)).start()
+        with self.assertRaises(ValueError) as caught:
+            hedger.call("find", calls, "x")
+        self.assertEqual(str(caught.exception), "second")
+
+    def test_fast_failure_not_hedged(self):
+        calls = Calls(ValueError("first"), "second")
+        calls.release(0, 1)
+        self.assertRaises(ValueError, warmed(1.0).call, "find", calls, "x")
+        self.assertEqual(len(calls.contexts), 1)
+
+    def test_context_carried(self):
+        calls = Calls("first", "second")
+        calls.release(1)
+        tracing.set_trace_id("trace")
+        try:
+            with deadlines.within(5):
+                deadline = deadlines.current()
+                warmed().call("find", calls, "x")
+        finally:
+            tracing.set_trace_id(None)
+        self.assertEqual(calls.contexts, [(deadline, "trace")] * 2)
+        calls.release(0)
+
+    def test_deadline(self):
+        calls = Calls("first", "second")
+        start = time.time()
+        with deadlines.within(0.2):
+            self.assertRaises(deadlines.DeadlineExceeded, warmed().call, "find", calls, "x")
+        self.assertTrue(time.time() - start < 1)
+        calls.release(0, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
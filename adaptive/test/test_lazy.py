@@ -0,0 +1,118 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json, sys, threading, unittest
+
+from adaptive.python import lazy, runtime
+from adaptive.python.runtime import AdaptiveValue, AdaptiveValueType
+
+
+@AdaptiveValue
+class LazyPet(AdaptiveValueType):
+    __slots__ = "name", "age"
+
+    def __init__(self, name, age):
+        self.name = name
+        self.age = age
+
+
+class LazyTest(unittest.TestCase):
+
+    def test_matches_runtime(self):
+        for value in [None, 1, "x", [], {}, [[]], [1, [2, [3, []]], 4], {"a": [1, {"b": []}]},
+                      [LazyPet("Fido", 3), {"pets": [LazyPet("Tom", 5)]}, None]]:
+            data = runtime.serialize(value)
+            self.assertEqual(lazy.deserialize(data), runtime.deserialize(data))
+
+    def test_whitespace(self):
+        data = ' [ 1 ,\n[ ] , { "a" : [ 2 ] } , [ 3 , 4 ] ] '
+        self.assertEqual(lazy.deserialize(data), json.loads(data))
+
+    def test_brackets_in_strings(self):
+        items = ["]", "[", "{", "}", '"]', '\\', '\\"]', u"\u2603 ]"]
+        data = json.dumps([items, {"k]": "v["}, items])
+        self.assertEqual(lazy.deserialize(data), [items, {"k]": "v["}, items])
+
+    def test_access(self):
+        pets = lazy.deserialize(runtime.serialize([[i] for i in range(10)]))
+        self.assertEqual(pets[3], [3])
+        self.assertEqual(len(pets.items), 4)
+        self.assertEqual(pets[-1], [9])
+        self.assertEqual(pets[2:4], [[2], [3]])
+        self.assertEqual(len(pets), 10)
+        self.assertRaises(IndexError, lambda: pets[10])
+
+    def test_partial_iteration(self):
+        # Reading past an unread nested list skips over its text.
+        items = lazy.deserialize("[[1, [2]], [3], 4]")
+        first = next(iter(items))
+        self.assertEqual(items[1:], [[3], 4])
+        self.assertEqual(first, [1, [2]])
+
+    def test_lazy_values(self):
+        pets = lazy.deserialize(runtime.serialize([LazyPet("Fido", 3), LazyPet("Tom", 5)]))
+        pet = pets[0]
+        self.assertTrue(isinstance(pet, LazyPet))
+        self.assertNotEqual(pet.__span__, None)
+        self.assertEqual(pet.name, "Fido")
+        self.assertEqual(pet.__span__, None)
+        pets[1].age = 6
+        self.assertEqual(pets[1].name, "Tom")
+        self.assertEqual(pets, [LazyPet("Fido", 3), LazyPet("Tom", 6)])
+
+    def test_missing_slot(self):
+        pet = lazy.deserialize('[{"%s": "LazyPet", "name": "Fido"}]' % runtime.CLASS_KEY)[0]
+        self.assertEqual(pet.name, "Fido")
+        self.assertRaises(AttributeError, lambda: pet.age)
+
+    def test_references(self):
+        pet = LazyPet("Fido", 3)
+        result = lazy.deserialize(runtime.serialize([pet, pet], share=True))
+        self.assertTrue(result[0] is result[1])
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, lazy.deserialize, "{} 2")
+        items = lazy.deserialize("[1, 2 3]")
+        self.assertEqual(items[0], 1)
+        self.assertRaises(ValueError, len, items)
+        self.assertRaises(ValueError, list, lazy.deserialize("[[1, 2]"))
+
+    def test_threads(self):
+        # As when a lazy result is shared by SingleFlight or a client cache
+        value = [[LazyPet("p%d" % i, i) for i in range(200)], [[i] for i in range(200)]]
+        expected = runtime.deserialize(runtime.serialize(value))
+        for attempt in range(20):
+            shared = lazy.deserialize(runtime.serialize(value))
+            results = []
+
+            def read():
+                try:
+                    results.append([[(pet.name, pet.age) for pet in shared[0]], list(shared[1])])
+                except Exception as exc:
+                    results.append(exc)
+            threads = [threading.Thread(target=read) for _ in range(4)]
+            interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                sys.setcheckinterval(interval)
+            self.assertEqual(results, [[[(pet.name, pet.age) for pet in expected[0]], expected[1]]] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json, socket, threading, unittest
+
+from adaptive.python.pipeline import PipelinedClient
+
+
+class Server(object):
+    """
+    Raw HTTP server that answers each call with its first argument. The
+    nth connection is handled as policies[n] says, and any after the last
+    as "answer":
+
+      "drop": read the first request and close without answering
+      "close": wait for two requests, then answer the first with
+               Connection: close and close
+    """
+
+    def __init__(self, *policies):
+        self.policies = list(policies)
+        self.calls = []  # (connection number, method name) as received
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(8)
+        self.url = "http://127.0.0.1:%d/Test" % self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        number = 0
+        while True:
+            conn, _ = self.sock.accept()
+            policy = self.policies[number] if number < len(self.policies) else "answer"
+            thread = threading.Thread(target=self.handle, args=(conn, number, policy))
+            thread.daemon = True
+            thread.start()
+            number += 1
+
+    def handle(self, conn, number, policy):
+        rfile = conn.makefile("rb")
+        try:
+            if policy == "drop":
+                self.read(rfile, number)
+            elif policy == "close":
+                first, _ = self.read(rfile, number), self.read(rfile, number)
+                self.answer(conn, first, "Connection: close\r\n")
+                conn.shutdown(socket.SHUT_WR)
+                while conn.recv(4096):  # Until the client is done with it
+                    pass
+            else:
+                while True:
+                    args = self.read(rfile, number)
+                    if args is None:
+                        break
+                    self.answer(conn, args)
+        finally:
+            rfile.close()
+            conn.close()
+
+    def read(self, rfile, number):
+        """Arguments of the next call, or None at the end of the connection"""
+        length = None
+        while True:
+            line = rfile.readline()
+            if not line:
+                return None
+            if line == "\r\n":
+                break
+            name, _, value = line.partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        name, args = json.loads(rfile.read(length))
+        self.calls.append((number, name))
+        return args
+
+    def answer(self, conn, args, headers=""):
+        body = json.dumps([True, args[0]])
+        conn.sendall("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n%s"
+                     "Content-Length: %d\r\n\r\n%s" % (headers, len(body), body))
+
+
+class PipelineTest(unittest.TestCase):
+
+    def client(self, server):
+        client = PipelinedClient(server.url, connections=1, timeout=5)
+        self.addCleanup(client.close)
+        return client
+
+    def test_calls(self):
+        server = Server()
+        client = self.client(server)
+        futures = [client.call_async("echo", [i]) for i in range(20)]
+        self.assertEqual([future.result() for future in futures], range(20))
+        self.assertEqual(set(number for number, _ in server.calls), set([0]))
+
+    def test_idempotent_retried(self):
+        server = Server("drop")
+        self.assertEqual(self.client(server).fetch("find", ["x"]), "x")
+        self.assertEqual(server.calls, [(0, "find"), (1, "find")])
+
+    def test_idempotent_retried_once(self):
+        server = Server("drop", "drop")
+        self.assertRaises(socket.error, self.client(server).fetch, "find", ["x"])
+        self.assertEqual(server.calls, [(0, "find"), (1, "find")])
+
+    def test_not_idempotent(self):
+        server = Server("drop")
+        self.assertRaises(socket.error, self.client(server).call, "add", ["x"])
+        self.assertEqual(server.calls, [(0, "add")])
+
+    def test_connection_close(self):
+        # The server read nothing after the request it answered with
+        # Connection: close, so the next one is sent again even though it
+        # is not idempotent.
+        server = Server("close")
+        client = self.client(server)
+        first, second = client.call_async("add", ["a"]), client.call_async("add", ["b"])
+        self.assertEqual((first.result(), second.result()), ("a", "b"))
+        self.assertEqual(server.calls, [(0, "add"), (0, "add"), (1, "add")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from adaptive.python.resultcache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache()
+
+    def put(self, key, response):
+        self.cache.put(key, response, self.cache.generation(key[0]))
+
+    def test_get_put(self):
+        key = "PetStore", "findPets", "[]"
+        self.assertEqual(self.cache.get(key), None)
+        self.put(key, "pets")
+        self.assertEqual(self.cache.get(key), "pets")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_invalidate_methods(self):
+        self.put(("PetStore", "findPets", "[]"), "pets")
+        self.put(("PetStore", "findPetById", "[1]"), "pet")
+        self.put(("Other", "findPets", "[]"), "other")
+        self.cache.invalidate("PetStore", ["findPets"])
+        self.assertEqual(self.cache.get(("PetStore", "findPets", "[]")), None)
+        self.assertEqual(self.cache.get(("PetStore", "findPetById", "[1]")), "pet")
+        self.assertEqual(self.cache.get(("Other", "findPets", "[]")), "other")
+
+    def test_invalidate_service(self):
+        self.put(("PetStore", "findPets", "[]"), "pets")
+        self.put(("PetStore", "findPetById", "[1]"), "pet")
+        self.put(("Other", "findPets", "[]"), "other")
+        self.cache.invalidate("PetStore")
+        self.assertEqual(self.cache.get(("PetStore", "findPets", "[]")), None)
+        self.assertEqual(self.cache.get(("PetStore", "findPetById", "[1]")), None)
+        self.assertEqual(self.cache.get(("Other", "findPets", "[]")), "other")
+        self.assertEqual(self.cache.keys.keys(), [("Other", "findPets")])
+
+    def test_stale_generation(self):
+        # A result computed before an invalidation is not kept after it.
+        key = "PetStore", "findPets", "[]"
+        generation = self.cache.generation("PetStore")
+        self.cache.invalidate("PetStore", ["findPetById"])
+        self.assertEqual(self.cache.generation("PetStore"), generation + 1)
+        self.cache.put(key, "stale", generation)
+        self.assertEqual(self.cache.get(key), None)
+        self.cache.put(key, "fresh", self.cache.generation("PetStore"))
+        self.assertEqual(self.cache.get(key), "fresh")
+
+    def test_generations_per_service(self):
+        generation = self.cache.generation("PetStore")
+        self.cache.invalidate("Other")
+        self.put(("PetStore", "findPets", "[]"), "pets")
+        self.assertEqual(self.cache.generation("PetStore"), generation)
+        self.assertEqual(self.cache.get(("PetStore", "findPets", "[]")), "pets")
+
+    def test_lru(self):
+        cache = self.cache = ResultCache(max_entries=2)
+        self.put(("S", "m", 1), "one")
+        self.put(("S", "m", 2), "two")
+        cache.get(("S", "m", 1))
+        self.put(("S", "m", 3), "three")
+        self.assertEqual(cache.get(("S", "m", 2)), None)
+        self.assertEqual(cache.get(("S", "m", 1)), "one")
+        self.assertEqual(cache.get(("S", "m", 3)), "three")
+        self.assertEqual(cache.keys[("S", "m")], set([("S", "m", 1), ("S", "m", 3)]))
+
+    def test_replace(self):
+        key = "S", "m", 1
+        self.put(key, "old")
+        self.put(key, "new")
+        self.assertEqual(self.cache.get(key), "new")
+        self.assertEqual(len(self.cache.entries), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
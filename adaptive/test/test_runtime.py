@@ -0,0 +1,88 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json, unittest
+
+from adaptive.python import runtime
+from adaptive.python.runtime import AdaptiveValue, AdaptiveValueType, ID_KEY, REF_KEY
+
+
+@AdaptiveValue
+class Node(AdaptiveValueType):
+    __slots__ = "name", "next", "children"
+
+    def __init__(self, name, next=None, children=()):
+        self.name = name
+        self.next = next
+        self.children = list(children)
+
+
+def roundtrip(value):
+    return runtime.deserialize(runtime.serialize(value, share=True))
+
+
+class RuntimeTest(unittest.TestCase):
+
+    def test_plain(self):
+        value = [Node("a", Node("b")), {"x": [1, 2]}, None]
+        self.assertEqual(runtime.serialize(value, share=True), runtime.serialize(value))
+        self.assertEqual(roundtrip(value), value)
+
+    def test_shared(self):
+        leaf = Node("leaf")
+        root = Node("root", leaf, [leaf, Node("other", leaf)])
+        jsonable = runtime.to_jsonable(root)
+        self.assertEqual(json.dumps(jsonable).count('"leaf"'), 1)
+        result = roundtrip(root)
+        self.assertTrue(result.next is result.children[0])
+        self.assertTrue(result.next is result.children[1].next)
+        self.assertEqual(result.next.name, "leaf")
+
+    def test_self_cycle(self):
+        node = Node("loop")
+        node.next = node
+        result = roundtrip(node)
+        self.assertTrue(result.next is result)
+
+    def test_cycle(self):
+        a, b = Node("a"), Node("b")
+        a.next, b.next = b, a
+        a.children = [b]
+        result = roundtrip([a, b])
+        self.assertTrue(result[0].next is result[1])
+        self.assertTrue(result[1].next is result[0])
+        self.assertTrue(result[0].children[0] is result[1])
+
+    def test_forward_reference(self):
+        # Object keys are unordered, so a reference may be read before
+        # the value it refers to.
+        data = [{REF_KEY: 0}, {runtime.CLASS_KEY: "Node", ID_KEY: 0, "name": "n", "next": None, "children": []}]
+        result = runtime.from_jsonable(data)
+        self.assertTrue(result[0] is result[1])
+        self.assertEqual(result[0].name, "n")
+
+    def test_not_shared_without_share(self):
+        leaf = Node("leaf")
+        result = runtime.deserialize(runtime.serialize([leaf, leaf]))
+        self.assertEqual(result[0], result[1])
+        self.assertFalse(result[0] is result[1])
+
+    def test_equality(self):
+        self.assertEqual(Node("a", Node("b")), Node("a", Node("b")))
+        self.assertNotEqual(Node("a", Node("b")), Node("a", Node("c")))
+        self.assertFalse(Node("a", Node("b")) != Node("a", Node("b")))
+
+
+if __name__ == "__main__":
+    unittest.main()
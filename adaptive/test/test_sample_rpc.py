@@ -0,0 +1,245 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import httplib, json, socket, threading, time, unittest, urllib2, zlib
+
+from adaptive.python import sample_rpc
+from adaptive.python.sample_rpc import RPCClient, ServiceRequestHandler, PooledHTTPServer
+
+
+class Server(object):
+    """
+    Raw HTTP server that answers each call with its first argument. The
+    nth connection is handled as policies[n] says, and any after the last
+    as "answer":
+
+      "idle-close": answer the first request and close
+      "answer-drop": answer the first request, then read the second and
+                     close without answering
+    """
+
+    def __init__(self, *policies):
+        self.policies = list(policies)
+        self.calls = []  # (connection number, method name) as received
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(8)
+        self.url = "http://127.0.0.1:%d/Test" % self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        number = 0
+        while True:
+            conn, _ = self.sock.accept()
+            policy = self.policies[number] if number < len(self.policies) else "answer"
+            thread = threading.Thread(target=self.handle, args=(conn, number, policy))
+            thread.daemon = True
+            thread.start()
+            number += 1
+
+    def handle(self, conn, number, policy):
+        rfile = conn.makefile("rb")
+        try:
+            answered = 0
+            while policy == "answer" or answered < 1:
+                args = self.read(rfile, number)
+                if args is None:
+                    break
+                self.answer(conn, args)
+                answered += 1
+            if policy == "answer-drop":
+                self.read(rfile, number)
+        finally:
+            rfile.close()
+            conn.close()
+
+    def read(self, rfile, number):
+        """Arguments of the next call, or None at the end of the connection"""
+        request = rfile.readline()
+        if not request:
+            return None
+        length = None
+        while True:
+            line = rfile.readline()
+            if line in ("", "\r\n"):
+                break
+            name, _, value = line.partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+        if length is None:  # A GET, with the call in the path after /Test/
+            name, args = sample_rpc.url_path_to_call(request.split()[1].split("/", 2)[2])
+        else:
+            name, args = json.loads(rfile.read(length))
+        self.calls.append((number, name))
+        return args
+
+    def answer(self, conn, args):
+        body = json.dumps([True, args[0]])
+        conn.sendall("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                     "Content-Length: %d\r\n\r\n%s" % (len(body), body))
+
+
+class PoolTest(unittest.TestCase):
+
+    def client(self, server):
+        client = RPCClient(server.url, timeout=5, compression=False)
+        self.addCleanup(client.close)
+        return client
+
+    def test_reused(self):
+        server = Server()
+        client = self.client(server)
+        self.assertEqual([client.call("add", [i]) for i in range(3)], range(3))
+        self.assertEqual(server.calls, [(0, "add")] * 3)
+
+    def test_closed_while_idle(self):
+        server = Server("idle-close")
+        client = self.client(server)
+        self.assertEqual(client.call("add", ["a"]), "a")
+        time.sleep(0.2)  # For the close to reach the client
+        self.assertEqual(client.call("add", ["b"]), "b")
+        self.assertEqual(server.calls, [(0, "add"), (1, "add")])
+
+    def test_post_not_resent(self):
+        server = Server("answer-drop")
+        client = self.client(server)
+        self.assertEqual(client.call("add", ["a"]), "a")
+        self.assertRaises(httplib.HTTPException, client.call, "add", ["b"])
+        self.assertEqual(server.calls, [(0, "add"), (0, "add")])
+
+    def test_get_resent(self):
+        server = Server("answer-drop")
+        client = self.client(server)
+        self.assertEqual(client.fetch("find", ["a"]), "a")
+        self.assertEqual(client.fetch("find", ["b"]), "b")
+        self.assertEqual(server.calls, [(0, "find"), (0, "find"), (1, "find")])
+
+
+class Unencodable(object):
+
+    def __init__(self):
+        self.runs = 0
+
+    def get(self):
+        self.runs += 1
+        return object()
+
+
+class QuietHandler(ServiceRequestHandler):
+    registry = None
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(test, name, instance, handler_class=QuietHandler):
+    """Serve instance as name for the length of test; returns its URL"""
+    server = PooledHTTPServer(("127.0.0.1", 0), handler_class, workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(server.drain, 1)
+    test.addCleanup(server.shutdown)
+    sample_rpc.add_instance(name, instance)
+    test.addCleanup(ServiceRequestHandler.services.pop, name)
+    return "http://127.0.0.1:%d/%s" % (server.server_address[1], name)
+
+
+class EncodeFailureTest(unittest.TestCase):
+
+    def test_answered(self):
+        # The server answers 500 and closes the connection, so the client
+        # neither hangs nor sends the call again.
+        instance = Unencodable()
+        client = RPCClient(serve(self, "Unencodable", instance), timeout=5)
+        self.addCleanup(client.close)
+        for runs in (1, 2):
+            with self.assertRaises(urllib2.HTTPError) as caught:
+                client.call("get", [])
+            self.assertEqual(caught.exception.code, 500)
+            self.assertEqual(instance.runs, runs)
+
+
+class Texts(object):
+
+    def big(self):
+        return ["pet %d" % idx for idx in range(1000)]
+
+    def small(self):
+        return "pet"
+
+
+class Uncompressed(QuietHandler):
+    compression_levels = {"big": 0}
+
+
+class CompressionTest(unittest.TestCase):
+
+    def post(self, url, name, accept_encoding=None):
+        """Content-Encoding and body of the response to a raw call of name"""
+        parts = url.split("/")
+        conn = httplib.HTTPConnection(parts[2], timeout=5)
+        self.addCleanup(conn.close)
+        headers = {"Content-Type": sample_rpc.CONTENT_TYPE}
+        if accept_encoding:
+            headers["Accept-Encoding"] = accept_encoding
+        conn.request("POST", "/" + parts[3], sample_rpc.call_to_body(name, []), headers)
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        return response.getheader("Content-Encoding"), response.read()
+
+    def test_negotiate(self):
+        for accept_encoding, coding in [(None, None), ("", None), ("identity", None), ("gzip", "gzip"),
+                                        ("deflate, gzip;q=0.5", "deflate"), ("gzip;q=0, deflate;q=0", None),
+                                        ("*", "gzip"), ("*;q=0, deflate", "deflate"), ("GZIP;q=bad", None),
+                                        ("br, gzip ; q=0.8", "gzip")]:
+            self.assertEqual(sample_rpc.negotiate_encoding(accept_encoding), coding, accept_encoding)
+
+    def test_codings(self):
+        data = "pets " * 1000
+        for coding in sample_rpc.ENCODINGS:
+            compressed = sample_rpc.compress(data, coding, 6)
+            self.assertTrue(len(compressed) < len(data))
+            self.assertEqual(sample_rpc.decompress(compressed, coding), data)
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.assertEqual(sample_rpc.decompress(raw.compress(data) + raw.flush(), "deflate"), data)
+        self.assertEqual(sample_rpc.decompress(data, "identity"), data)
+        self.assertRaises(httplib.HTTPException, sample_rpc.decompress, data, "br")
+
+    def test_server(self):
+        url = serve(self, "Texts", Texts())
+        expected = json.dumps([True, Texts().big()], separators=(",", ":"))
+        coding, body = self.post(url, "big", "gzip")
+        self.assertEqual(coding, "gzip")
+        self.assertEqual(sample_rpc.decompress(body, coding), expected)
+        self.assertEqual(self.post(url, "big"), (None, expected))
+        self.assertEqual(self.post(url, "small", "gzip")[0], None)  # Below compression_min_size
+
+    def test_method_level(self):
+        url = serve(self, "Texts", Texts(), Uncompressed)
+        self.assertEqual(self.post(url, "big", "gzip")[0], None)
+
+    def test_client(self):
+        url = serve(self, "Texts", Texts())
+        for compression in (True, False):
+            client = RPCClient(url, timeout=5, compression=compression)
+            self.addCleanup(client.close)
+            self.assertEqual(client.call("big", []), Texts().big())
+            self.assertEqual(client.fetch("small", []), "pet")
+
+
+if __name__ == "__main__":
+    unittest.main()
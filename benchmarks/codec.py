@@ -0,0 +1,129 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the runtime's compiled value codecs against the original
+reflective ones, the binary codec against JSON, and lazy against eager
+JSON decoding, on a large list of Pet-like values.
+
+Usage: python benchmarks/codec.py [count] [repeat]
+"""
+
+import json, sys, timeit
+
+from adaptive.python.runtime import AdaptiveValue, AdaptiveValueType, serialize, deserialize
+from adaptive.python import binary, lazy
+
+
+@AdaptiveValue
+class Pet(AdaptiveValueType):
+    __slots__ = "id", "name", "tag"
+
+    def __init__(self, id, name, tag=None):
+        self.id = id
+        self.name = name
+        self.tag = tag
+
+
+# The reflective codecs the runtime used before AdaptiveValue compiled them.
+
+class ReflectiveEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, AdaptiveValueType):
+            res = {"__adaptive_class_name__": obj.__class__.__name__}
+            for slot_name in obj.__slots__:
+                value = getattr(obj, slot_name)
+                if isinstance(value, AdaptiveValueType):
+                    value = self.default(value)
+                res[slot_name] = value
+            return res
+        return json.JSONEncoder.default(self, obj)
+
+
+def reflective_hook(obj_dict):
+    try:
+        class_ = AdaptiveValueType.__known_subclasses__[obj_dict["__adaptive_class_name__"]]
+        return class_(*[obj_dict[slot_name] for slot_name in class_.__slots__])
+    except KeyError:
+        return obj_dict
+
+
+def reflective_serialize(obj):
+    return json.dumps(obj, cls=ReflectiveEncoder, separators=(',', ':'))
+
+
+def reflective_deserialize(data):
+    return json.loads(data, object_hook=reflective_hook)
+
+
+def make_pets(count):
+    tags = ["cat", "dog", "bird", None]
+    return [Pet(idx, "pet-%d" % idx, tags[idx % len(tags)]) for idx in range(count)]
+
+
+def best(func, arg, repeat):
+    return min(timeit.repeat(lambda: func(arg), number=1, repeat=repeat))
+
+
+def report(label, names, before, after):
+    print "%-12s %s %8.2f ms   %s %8.2f ms   speedup %.2fx" % (
+        label, names[0], before * 1000, names[1], after * 1000, before / after)
+
+
+def compare(label, baseline, candidate, arg, repeat):
+    report(label, ("reflective", "compiled"), best(baseline, arg, repeat), best(candidate, arg, repeat))
+
+
+def main(count=10000, repeat=5):
+    pets = make_pets(count)
+    data = serialize((True, pets))
+    assert deserialize(reflective_serialize((True, pets)))[1] == pets
+    assert reflective_deserialize(data)[1] == deserialize(data)[1] == pets
+
+    print "%d pets, %d bytes, best of %d" % (count, len(data), repeat)
+    compare("serialize", reflective_serialize, serialize, (True, pets), repeat)
+    compare("deserialize", reflective_deserialize, deserialize, data, repeat)
+    plain = json.dumps([{"id": idx, "name": "n"} for idx in range(count)])
+    compare("plain dicts", reflective_deserialize, deserialize, plain, repeat)
+
+    packed = binary.serialize((True, pets))
+    assert binary.deserialize(packed)[1] == pets
+    print
+    print "binary: %d bytes (%.0f%% of JSON)" % (len(packed), 100.0 * len(packed) / len(data))
+    names = "json", "binary"
+    report("serialize", names, best(serialize, (True, pets), repeat),
+           best(binary.serialize, (True, pets), repeat))
+    report("deserialize", names, best(deserialize, data, repeat),
+           best(binary.deserialize, packed, repeat))
+
+    assert lazy.deserialize(data)[1] == pets
+    def first(decode):
+        def names(data):
+            pets = decode(data)[1]
+            return [pets[idx].name for idx in range(10)]
+        return names
+
+    def every(decode):
+        return lambda data: [pet.name for pet in decode(data)[1]]
+
+    print
+    names = "eager", "lazy"
+    report("first 10", names, best(first(deserialize), data, repeat),
+           best(first(lazy.deserialize), data, repeat))
+    report("every name", names, best(every(deserialize), data, repeat),
+           best(every(lazy.deserialize), data, repeat))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,92 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmarks of the runtime codecs on results of several sizes, and
+of generating the petstore example's code, with results saved in the
+format results.py compares.
+
+Usage: python benchmarks/micro.py [--repeat=N] [--save=FILE]
+"""
+
+import argparse, os, shutil, tempfile
+
+from adaptive.python import runtime, binary, lazy
+from codec import make_pets, best
+from results import ROOT, Results
+
+SIZES = 1, 100, 10000
+
+CODECS = [
+    ("json", runtime.serialize, runtime.deserialize),
+    ("binary", binary.serialize, binary.deserialize),
+    ("lazy", runtime.serialize, lambda data: lazy.deserialize(data)[1][0]),  # first item only
+]
+
+
+def codecs(results, repeat):
+    for count in SIZES:
+        output = (True, make_pets(count))
+        for name, serialize, deserialize in CODECS:
+            data = serialize(output)
+            # Small inputs run many times per sample, for a measurable time
+            number = max(1, 10000 // count)
+            encode = best(lambda arg: [serialize(arg) for _ in xrange(number)], output, repeat) / number
+            decode = best(lambda arg: [deserialize(arg) for _ in xrange(number)], data, repeat) / number
+            results.record("codec.%s.%d" % (name, count), bytes=len(data),
+                           serialize_ms=encode * 1000, deserialize_ms=decode * 1000)
+            print "%-8s %6d pets %9d bytes   serialize %9.4f ms   deserialize %9.4f ms" % (
+                name, count, len(data), encode * 1000, decode * 1000)
+
+
+def codegen(results, repeat):
+    try:
+        from adaptive import compiler
+        from quark.backend import Java, Python
+    except ImportError as exc:
+        print "codegen skipped: %s" % exc
+        return
+    path = os.path.join(ROOT, "examples", "petstore", "petstore.q")
+    with open(path, "rb") as fd:
+        sources = [(path, fd.read())]
+    for side in sorted(compiler.ANNOTATORS):
+        for backend in Java, Python:
+            def generate(backend):
+                target = tempfile.mkdtemp()
+                try:
+                    error = compiler.generate_code(side, sources, [(backend, target)])
+                    if error is not None:
+                        raise RuntimeError(str(error))
+                finally:
+                    shutil.rmtree(target, ignore_errors=True)
+            elapsed = best(generate, backend, repeat)
+            results.record("codegen.%s.%s" % (side, backend.__name__.lower()), generate_ms=elapsed * 1000)
+            print "codegen  %-6s %-6s %9.2f ms" % (side, backend.__name__.lower(), elapsed * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Codec and codegen micro-benchmarks.")
+    parser.add_argument("--repeat", type=int, default=5, help="samples per benchmark; the best counts")
+    parser.add_argument("--save", metavar="FILE", help="write results as JSON, for results.py")
+    args = parser.parse_args()
+
+    results = Results(repeat=args.repeat)
+    codecs(results, args.repeat)
+    codegen(results, args.repeat)
+    if args.save:
+        results.save(args.save)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark results files, and comparing two of them.
+
+A results file is JSON: {"meta": {...}, "results": {name: {metric: value}}}.
+Metrics ending in _ms are better lower and those ending in _per_s are
+better higher; other metrics are informational.
+
+Usage: python benchmarks/results.py <old.json> <new.json> [threshold percent]
+
+Prints the change in every metric the two files share and exits with
+status 1 if any got worse by more than threshold percent (default 10).
+"""
+
+import json, math, os, platform, subprocess, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of samples, which must be sorted"""
+    if not samples:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(samples))) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+def revision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                           cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Results(object):
+
+    def __init__(self, **meta):
+        self.meta = dict(meta, revision=revision(), python=platform.python_version(),
+                         platform=platform.platform(), time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        self.results = {}
+
+    def record(self, name, **metrics):
+        self.results.setdefault(name, {}).update(metrics)
+
+    def save(self, path):
+        with open(path, "w") as fd:
+            json.dump({"meta": self.meta, "results": self.results}, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+
+
+def load(path):
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def direction(metric):
+    """1 if higher is better, -1 if lower is, None if metric is not compared"""
+    if metric.endswith("_per_s"):
+        return 1
+    if metric.endswith("_ms"):
+        return -1
+    return None
+
+
+def compare(old, new, threshold):
+    """Yield (name, metric, old value, new value, percent change, regressed)"""
+    for name in sorted(set(old["results"]) & set(new["results"])):
+        before, after = old["results"][name], new["results"][name]
+        for metric in sorted(set(before) & set(after)):
+            sign = direction(metric)
+            if sign is None or not before[metric] or after[metric] is None:
+                continue
+            change = 100.0 * (after[metric] - before[metric]) / before[metric]
+            yield name, metric, before[metric], after[metric], change, sign * change < -threshold
+
+
+def main(old_path, new_path, threshold=10.0):
+    old, new = load(old_path), load(new_path)
+    print "old: %s  %s" % (old["meta"].get("revision"), old["meta"].get("time"))
+    print "new: %s  %s" % (new["meta"].get("revision"), new["meta"].get("time"))
+    regressions = 0
+    for name, metric, before, after, change, regressed in compare(old, new, float(threshold)):
+        print "%-32s %-12s %10.2f %10.2f %+8.1f%%%s" % (
+            name, metric, before, after, change, "  REGRESSION" if regressed else "")
+        regressions += regressed
+    if regressions:
+        print "%d regressions beyond %s%%" % (regressions, threshold)
+        return 1
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        sys.exit(__doc__)
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,222 @@
+# Copyright 2015 datawire. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End-to-end load test of the petstore example. Starts the service with
+psserver.py (sample_rpc) and/or psflask.py, drives it from a number of
+client threads with a weighted mix of calls for a fixed time, and
+reports throughput and p50/p95/p99 latency per method.
+
+The servers import PetStore_server, so generate it first:
+
+    adaptive server --python=examples/petstore examples/petstore/petstore.q
+
+Calls go through sample_rpc.RPCClient the way a generated client makes
+them: queries as fetches, operations as calls. The load runs in a
+separate process from the server, so the two do not share a GIL.
+"""
+
+import argparse, itertools, os, random, socket, subprocess, sys, tempfile, threading, time
+
+from adaptive.python import sample_rpc
+from results import ROOT, Results, percentile
+
+PETSTORE = os.path.join(ROOT, "examples", "petstore")
+SERVERS = {"sample_rpc": "psserver.py", "flask": "psflask.py"}
+TAGS = ["cat", "dog", "bird", None]
+DEFAULT_MIX = "findPets=4,findPetById=4,addPet=1,deletePet=1"
+
+
+def parse_mix(spec):
+    """"name=weight,..." -> [(name, weight)]"""
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in CALLS:
+            raise ValueError("unknown method %r in mix" % name)
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+# Each call takes the client, a random.Random and the ids of the pets
+# this worker added, and returns False if it could not be made.
+
+def find_pets(client, rand, added):
+    client.fetch("findPets", [[rand.choice(TAGS)], 10])
+
+
+def find_pet_by_id(client, rand, added):
+    client.fetch("findPetById", [rand.randrange(SEEDED)])
+
+
+def add_pet(client, rand, added):
+    pet = client.call("addPet", ["pet", rand.choice(TAGS)])
+    # A map unless a generated client has registered the Pet class
+    added.append(pet["id"] if isinstance(pet, dict) else pet.id)
+
+
+def delete_pet(client, rand, added):
+    # Only pets this worker added, so the seeded ids stay valid
+    if not added:
+        return False
+    client.call("deletePet", [added.pop()])
+
+CALLS = {"findPets": find_pets, "findPetById": find_pet_by_id, "addPet": add_pet, "deletePet": delete_pet}
+SEEDED = 1000
+
+
+class Server(object):
+    """A petstore server script run in a subprocess on port"""
+
+    def __init__(self, script, port, timeout=15.0):
+        env = dict(os.environ, SERVER_PORT=str(port))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen([sys.executable, script], cwd=PETSTORE, env=env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + timeout
+        while not self.listening(port):
+            if self.process.poll() is not None or time.time() > deadline:
+                self.log.seek(0)
+                output = self.log.read()
+                self.stop()
+                raise RuntimeError("%s did not start:\n%s" % (script, output))
+            time.sleep(0.1)
+
+    @staticmethod
+    def listening(port):
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+        except socket.error:
+            return False
+        return True
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.log.close()
+
+
+def seed(client):
+    for idx in range(SEEDED):
+        client.call("addPet", ["seed-%d" % idx, TAGS[idx % len(TAGS)]])
+
+
+def worker(client, mix, deadline, seed, samples, errors):
+    rand = random.Random(seed)
+    total = sum(weight for name, weight in mix)
+    added = []
+    while time.time() < deadline:
+        pick = rand.random() * total
+        for name, weight in mix:
+            pick -= weight
+            if pick < 0:
+                break
+        start = time.time()
+        try:
+            if CALLS[name](client, rand, added) is False:
+                continue
+        except Exception:
+            errors[name] += 1
+            continue
+        samples[name].append(time.time() - start)
+
+
+def run_load(url, mix, concurrency, duration):
+    """Return {method: (sorted latencies in seconds, errors)} and the elapsed time"""
+    client = sample_rpc.RPCClient(url, pool_size=concurrency)
+    seed(client)
+    names = [name for name, weight in mix]
+    # One sample list per thread and method, merged afterwards, so that
+    # workers never contend on shared state while timing.
+    samples = [dict((name, []) for name in names) for idx in range(concurrency)]
+    errors = [dict((name, 0) for name in names) for idx in range(concurrency)]
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(client, mix, start + duration, idx,
+                                                     samples[idx], errors[idx]))
+               for idx in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    client.close()
+    merged = {}
+    for name in names:
+        latencies = sorted(itertools.chain(*[part[name] for part in samples]))
+        merged[name] = latencies, sum(part[name] for part in errors)
+    return merged, elapsed
+
+
+def summarize(latencies, errors, elapsed):
+    metrics = {"calls": len(latencies), "errors": errors, "calls_per_s": len(latencies) / elapsed}
+    for pct in (50, 95, 99):
+        value = percentile(latencies, pct)
+        metrics["p%d_ms" % pct] = None if value is None else value * 1000
+    return metrics
+
+
+def report(results, server, merged, elapsed):
+    print "%s: %.1fs" % (server, elapsed)
+    print "  %-12s %8s %6s %10s %9s %9s %9s" % ("method", "calls", "errors", "calls/s", "p50 ms", "p95 ms", "p99 ms")
+    everything = sorted(itertools.chain(*[latencies for latencies, errors in merged.values()]))
+    rows = sorted(merged.items()) + [("all", (everything, sum(errors for _, errors in merged.values())))]
+    for name, (latencies, errors) in rows:
+        metrics = summarize(latencies, errors, elapsed)
+        results.record("rpc.%s.%s" % (server, name), **metrics)
+        times = tuple("-" if metrics[key] is None else "%.2f" % metrics[key] for key in ("p50_ms", "p95_ms", "p99_ms"))
+        print "  %-12s %8d %6d %10.1f %9s %9s %9s" % ((name, metrics["calls"], errors, metrics["calls_per_s"]) + times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the petstore example.")
+    parser.add_argument("--server", action="append", choices=sorted(SERVERS),
+                        help="server to start, repeatable (default: all)")
+    parser.add_argument("--url", help="drive an already running PetStore service instead")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per server")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted call mix [%(default)s]")
+    parser.add_argument("--save", metavar="FILE", help="write results as JSON, for results.py")
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    results = Results(concurrency=args.concurrency, duration=args.duration, mix=args.mix)
+    failed = False
+    if args.url:
+        report(results, "external", *run_load(args.url, mix, args.concurrency, args.duration))
+    else:
+        for name in args.server or sorted(SERVERS):
+            try:
+                server = Server(SERVERS[name], args.port)
+            except RuntimeError as exc:
+                sys.stderr.write("%s\n" % exc)
+                failed = True
+                continue
+            try:
+                url = "http://127.0.0.1:%d/PetStore" % args.port
+                report(results, name, *run_load(url, mix, args.concurrency, args.duration))
+            finally:
+                server.stop()
+    if args.save:
+        results.save(args.save)
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -27,8 +27,51 @@ class Pet(object):
         self.tag = tag
 
 
+##     @store("id", "tag")
+
+class PetRepository(object):
+    """Pets indexed by id, with a secondary index on tag"""
+
+    def __init__(self):
+        self.items = {}
+        self.by_tag = {}  # tag -> {id -> Pet}
+        self.tag_of = {}  # id -> tag as of the last put
+
+    def size(self):
+        return len(self.items)
+
+    def get(self, id_):
+        return self.items.get(id_)
+
+    def all(self):
+        return self.items.values()
+
+    def put(self, value):
+        self.remove(value.id)
+        self.items[value.id] = value
+        self.tag_of[value.id] = value.tag
+        self.by_tag.setdefault(value.tag, {})[value.id] = value
+
+    def remove(self, id_):
+        value = self.items.pop(id_, None)
+        if value is None:
+            return None
+        tag = self.tag_of.pop(id_)
+        bucket = self.by_tag[tag]
+        del bucket[id_]
+        if not bucket:
+            del self.by_tag[tag]
+        return value
+
+    def find_by_tag(self, tag):
+        return self.by_tag.get(tag, {}).values()
+
+
 class PetStore_server(object):
 
+    queries = ["findPets", "findPetById"]
+    invalidates = {"addPet": ["findPets"]}
+
     def __init__(self, impl):
         self.impl = impl
 
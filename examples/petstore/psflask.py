@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from flask import Flask, abort
+import os
+
+from flask import Flask, abort, request
 app = Flask(__name__)
 
-from adaptive.python.sample_rpc import serialize, url_path_to_call, pack_exception
+from adaptive.python.sample_rpc import url_path_to_call, body_to_call, body_to_batch, \
+    run_method, run_batch, negotiate, CODECS, BATCH_PATH
+from adaptive.python import deadlines
 
 
 import petstore_impl
@@ -25,32 +29,63 @@ store = petstore_impl.PetStore()
 server = PetStore_server.PetStore_server(store)
 
 
-@app.route("/" + server.name + "/<call_path>")
-def run_service(call_path):
+@app.before_request
+def set_deadline():
+    deadlines.set_deadline(deadlines.from_header(request.headers.get(deadlines.DEADLINE_HEADER)))
+
+
+def respond(output):
+    codec = negotiate(request.headers.get("Accept"))
     try:
-        command, args = url_path_to_call(call_path)
-    except Exception:
-        return abort(400)
+        res = codec.serialize(output)
+    except Exception as exc:
+        print "Returning:", output
+        print "Failed because:", exc
+        raise
 
+    return res, 200, {"Content-Type": codec.content_type, "Vary": "Accept"}
+
+
+def invoke(command, args):
     try:
         method = getattr(server, command)
     except AttributeError:
         return abort(404)
+    return respond(run_method(method, args))
 
+
+@app.route("/" + server.name + "/<call_path>")
+def run_service(call_path):
     try:
-        output = True, method(*args)
-    except Exception as exc:
-        output = False, pack_exception(exc)
+        command, args = url_path_to_call(call_path)
+    except Exception:
+        return abort(400)
+    return invoke(command, args)
+
 
+@app.route("/" + server.name, methods=["POST"])
+def post_service():
+    codec = CODECS.get(request.mimetype)
+    if codec is None:
+        return abort(415)
     try:
-        res = serialize(output)
-    except Exception as exc:
-        print "Returning:", output
-        print "Failed because:", exc
-        raise
+        command, args = body_to_call(request.get_data(), codec)
+    except Exception:
+        return abort(400)
+    return invoke(command, args)
 
-    return res
+
+@app.route("/" + server.name + "/" + BATCH_PATH, methods=["POST"])
+def post_batch():
+    codec = CODECS.get(request.mimetype)
+    if codec is None:
+        return abort(415)
+    try:
+        calls = body_to_batch(request.get_data(), codec)
+    except Exception:
+        return abort(400)
+    return respond(run_batch(server, calls))
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    app.run(host="0.0.0.0", port=int(os.environ.get("SERVER_PORT", 8080)))